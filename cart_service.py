@@ -0,0 +1,143 @@
+"""Cart reads and batched cart mutations shared by the cart views."""
+from sqlalchemy.orm import joinedload
+
+from models import db, CartItem, Product
+from pricing import to_cents
+from upserts import add_wishlist_item
+
+MAX_BATCH_OPERATIONS = 100
+
+OPERATIONS = ('set', 'increase', 'decrease', 'remove', 'move_to_wishlist')
+
+
+class CartError(Exception):
+    """A batch could not be applied; nothing was written"""
+
+
+def load_cart(user_id):
+    """Cart rows with their products, loaded in one query"""
+    return CartItem.query.options(joinedload(CartItem.product)).filter_by(user_id=user_id).all()
+
+
+def cart_state(cart_items, totals):
+    """JSON-ready snapshot of a cart and its totals (see pricing.py)"""
+    items = [{
+        'item_id': item.product_id,
+        'name': item.product.name,
+        'quantity': item.quantity,
+        'price': item.product.price,
+        'line_total': item.quantity * to_cents(item.product.price) / 100,
+        'stock': item.product.stock,
+    } for item in cart_items]
+    return {'items': items, 'count': len(items), **totals}
+
+
+def _parse_operations(operations):
+    if not isinstance(operations, list) or not operations:
+        raise CartError('No cart operations given')
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise CartError(f'At most {MAX_BATCH_OPERATIONS} operations per batch')
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise CartError('Invalid cart operation')
+        op = operation.get('op')
+        if op not in OPERATIONS:
+            raise CartError(f'Unknown cart operation: {op}')
+        try:
+            product_id = int(operation.get('item_id'))
+            quantity = int(operation.get('quantity', 0)) if op == 'set' else None
+        except (TypeError, ValueError):
+            raise CartError('Invalid item or quantity')
+        if quantity is not None and quantity < 0:
+            raise CartError('Quantity cannot be negative')
+        parsed.append((op, product_id, quantity))
+    return parsed
+
+
+def _apply_in_memory(parsed, quantities, products):
+    """Run parsed operations against ``{product_id: quantity}``; returns (quantities, ids moved to the wishlist)"""
+    quantities = dict(quantities)
+    to_wishlist = []
+    for op, product_id, quantity in parsed:
+        if product_id not in products:
+            raise CartError('Item not found')
+        current = quantities.get(product_id, 0)
+        if op == 'set':
+            quantities[product_id] = quantity
+        elif op == 'increase':
+            quantities[product_id] = current + 1
+        elif op == 'decrease':
+            quantities[product_id] = max(current - 1, 0)
+        elif op == 'remove':
+            quantities[product_id] = 0
+        elif op == 'move_to_wishlist':
+            quantities[product_id] = 0
+            to_wishlist.append(product_id)
+    return quantities, to_wishlist
+
+
+def _check_stock(quantities, previous, products):
+    short = []
+    for product_id, product in products.items():
+        quantity = quantities.get(product_id, 0)
+        # Lowering a line that is already above stock is always allowed
+        if quantity > previous.get(product_id, 0) and quantity > (product.stock or 0):
+            short.append(product.name)
+    if short:
+        raise CartError('Not enough stock available for ' + ', '.join(sorted(short)))
+
+
+def apply_cart_operations(user_id, operations):
+    """Apply a batch of cart operations in the caller's transaction.
+
+    Operations are applied in order to an in-memory copy of the cart, stock is
+    validated once for the final quantities, and only then are the changed
+    rows written.  Raises ``CartError`` (having written nothing) if the batch
+    is invalid or asks for more than is in stock.
+    """
+    parsed = _parse_operations(operations)
+    product_ids = {product_id for _, product_id, _ in parsed}
+
+    rows = {item.product_id: item for item in CartItem.query
+            .options(joinedload(CartItem.product))
+            .filter(CartItem.user_id == user_id, CartItem.product_id.in_(product_ids))}
+    products = {item.product_id: item.product for item in rows.values()}
+    unknown = product_ids - set(products)
+    if unknown:
+        products.update({product.id: product for product in Product.query.filter(Product.id.in_(unknown))})
+
+    previous = {product_id: item.quantity for product_id, item in rows.items()}
+    quantities, to_wishlist = _apply_in_memory(parsed, previous, products)
+    _check_stock(quantities, previous, products)
+
+    for product_id, quantity in quantities.items():
+        item = rows.get(product_id)
+        if quantity == 0:
+            if item is not None:
+                db.session.delete(item)
+        elif item is None:
+            db.session.add(CartItem(user_id=user_id, product_id=product_id, quantity=quantity))
+        elif item.quantity != quantity:
+            item.quantity = quantity
+    db.session.flush()
+
+    for product_id in to_wishlist:
+        add_wishlist_item(user_id, product_id)
+
+
+def apply_guest_cart_operations(quantities, operations, load_products):
+    """Apply a batch of cart operations to a guest cart's ``{product_id: quantity}``.
+
+    ``load_products(ids)`` returns the products involved (anything with
+    ``id``, ``name`` and ``stock``).  Returns the new quantities, without the
+    lines that were emptied; raises ``CartError`` like ``apply_cart_operations``.
+    """
+    parsed = _parse_operations(operations)
+    if any(op == 'move_to_wishlist' for op, _, _ in parsed):
+        raise CartError('Log in to save items to your wishlist')
+    products = {product.id: product for product in load_products(sorted({product_id for _, product_id, _ in parsed}))}
+
+    new_quantities, _ = _apply_in_memory(parsed, quantities, products)
+    _check_stock(new_quantities, quantities, products)
+    return {product_id: quantity for product_id, quantity in new_quantities.items() if quantity}
@@ -0,0 +1,347 @@
+"""Read-through cache for catalog reads.
+
+Products are cached as detached ``CachedProduct`` snapshots so they can be
+shared between requests (and pickled into a shared backend) without holding
+on to a database session.  Listings, category lists and related products are
+stored under a catalog *generation*; any committed change to a ``Product``
+deletes that product's entry and bumps the generation, so every derived entry
+is invalidated at once and simply ages out of the LRU.  Stock changes (a
+checkout, a restock) only delete the products' own entries: listings and
+related products hold ids, not stock, so they stay valid.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+from models import db, Product
+from pagination import KeysetPage, Page, keyset_paginate
+from replicas import primary_reads
+
+try:
+    import redis
+except ImportError:  # redis is only needed for the shared backend
+    redis = None
+
+MISSING = object()
+CHANGED_PRODUCTS_KEY = 'catalog_changed_product_ids'
+STOCK_CHANGED_PRODUCTS_KEY = 'catalog_stock_changed_product_ids'
+STOCK_COLUMNS = frozenset({'stock', 'updated_at'})
+
+
+class CachedProduct(SimpleNamespace):
+    """Detached copy of a product's column values"""
+
+    @classmethod
+    def from_model(cls, product):
+        return cls(**{column.key: getattr(product, column.key) for column in Product.__table__.columns})
+
+
+class LRUCache:
+    """In-process cache with a size limit and per-entry TTL"""
+
+    def __init__(self, max_entries=2048, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+
+    def generation(self):
+        return self._generation
+
+    def bump_generation(self):
+        with self._lock:
+            self._generation += 1
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache:
+    """Cache shared by every worker process, backed by Redis"""
+
+    def __init__(self, url, ttl=300, prefix='shopease:catalog:'):
+        if redis is None:
+            raise RuntimeError('The redis package is required for CATALOG_CACHE_BACKEND=redis')
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self._client.get(self.prefix + key)
+        return MISSING if raw is None else pickle.loads(raw)
+
+    def set(self, key, value):
+        self._client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def delete_many(self, keys):
+        if keys:
+            self._client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        self.bump_generation()
+
+    def generation(self):
+        return int(self._client.get(self.prefix + 'generation') or 0)
+
+    def bump_generation(self):
+        self._client.incr(self.prefix + 'generation')
+
+    def __len__(self):
+        return 0
+
+
+class NullCache:
+    """Backend that never stores anything (CATALOG_CACHE_BACKEND=none)"""
+
+    def get(self, key):
+        return MISSING
+
+    def set(self, key, value):
+        pass
+
+    def delete_many(self, keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def generation(self):
+        return 0
+
+    def bump_generation(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class CatalogCache:
+    """Flask extension serving product, category, related and listing reads from cache"""
+
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.listeners = []
+        self.stock_listeners = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CATALOG_CACHE_BACKEND', 'memory')
+        app.config.setdefault('CATALOG_CACHE_TTL', 300)
+        app.config.setdefault('CATALOG_CACHE_MAX_ENTRIES', 2048)
+        app.config.setdefault('CATALOG_CACHE_URL', None)
+
+        backend = app.config['CATALOG_CACHE_BACKEND']
+        ttl = app.config['CATALOG_CACHE_TTL']
+        if backend == 'memory':
+            self.backend = LRUCache(app.config['CATALOG_CACHE_MAX_ENTRIES'], ttl)
+        elif backend == 'redis':
+            self.backend = RedisCache(app.config['CATALOG_CACHE_URL'], ttl)
+        elif backend == 'none':
+            self.backend = NullCache()
+        else:
+            raise ValueError(f'Unknown CATALOG_CACHE_BACKEND: {backend}')
+
+        app.extensions['catalog_cache'] = self
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.register_gauge('shopease_catalog_cache_hits', 'Catalog cache hits',
+                                   lambda: sum(self.hits.values()))
+            metrics.register_gauge('shopease_catalog_cache_misses', 'Catalog cache misses',
+                                   lambda: sum(self.misses.values()))
+            metrics.register_gauge('shopease_catalog_cache_entries', 'Entries in the in-process catalog cache',
+                                   lambda: len(self.backend))
+
+    def _loading(self):
+        # Entries outlive the request, so they are never filled from a lagging
+        # replica; without a backend nothing is kept and the replica is fine
+        return nullcontext() if isinstance(self.backend, NullCache) else primary_reads()
+
+    def _lookup(self, namespace, key, loader):
+        value = self.backend.get(key)
+        if value is not MISSING:
+            self.hits[namespace] += 1
+            return value
+        self.misses[namespace] += 1
+        with self._loading():
+            value = loader()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def product(self, product_id):
+        def load():
+            product = db.session.get(Product, product_id)
+            return CachedProduct.from_model(product) if product else None
+        return self._lookup('product', f'product:{product_id}', load)
+
+    def products(self, product_ids):
+        """Return snapshots for the given ids in order, loading every miss in one query"""
+        found = {}
+        for product_id in product_ids:
+            value = self.backend.get(f'product:{product_id}')
+            if value is not MISSING:
+                found[product_id] = value
+        self.hits['product'] += len(found)
+        missing = [product_id for product_id in product_ids if product_id not in found]
+        if missing:
+            self.misses['product'] += len(missing)
+            with self._loading():
+                products = Product.query.filter(Product.id.in_(missing)).all()
+            for product in products:
+                found[product.id] = CachedProduct.from_model(product)
+                self.backend.set(f'product:{product.id}', found[product.id])
+        return [found[product_id] for product_id in product_ids if product_id in found]
+
+    def categories(self):
+        def load():
+            rows = db.session.execute(select(Product.category).distinct()).scalars().all()
+            return [category for category in rows if category]
+        return self._lookup('categories', f'categories:{self.backend.generation()}', load)
+
+    def related(self, product, limit=4):
+        def load():
+            return db.session.execute(
+                select(Product.id)
+                .where(Product.category == product.category, Product.id != product.id)
+                .order_by(Product.id)
+                .limit(limit)
+            ).scalars().all()
+        key = f'related:{self.backend.generation()}:{product.id}:{limit}'
+        return self.products(self._lookup('related', key, load))
+
+    def listing(self, category, page, per_page):
+        """Return a Page of products, optionally restricted to one category"""
+        def load():
+            query = select(Product.id)
+            if category:
+                query = query.where(Product.category == category)
+            total = db.session.execute(select(func.count()).select_from(query.subquery())).scalar()
+            ids = db.session.execute(
+                query.order_by(Product.id).limit(per_page).offset((page - 1) * per_page)
+            ).scalars().all()
+            return ids, total
+        page = max(page, 1)
+        key = f'listing:{self.backend.generation()}:{category or ""}:{page}:{per_page}'
+        ids, total = self._lookup('listing', key, load)
+        return Page(self.products(ids), total, page, per_page)
+
+    def keyset_listing(self, category, cursor, per_page):
+        """Return a KeysetPage of products, newest first, starting at ``cursor``"""
+        def load():
+            query = db.session.query(Product.id, Product.created_at)
+            if category:
+                query = query.filter(Product.category == category)
+            rows, next_cursor, prev_cursor = keyset_paginate(
+                query, [Product.created_at, Product.id], cursor, per_page)
+            return [row.id for row in rows], next_cursor, prev_cursor
+        key = f'keyset:{self.backend.generation()}:{category or ""}:{cursor or ""}:{per_page}'
+        ids, next_cursor, prev_cursor = self._lookup('listing', key, load)
+        return KeysetPage(self.products(ids), per_page, next_cursor, prev_cursor)
+
+    def subscribe(self, callback, stock=False):
+        """Call ``callback(product_ids)`` whenever committed changes invalidate products.
+
+        Stock-only changes are reported only to callbacks subscribed with ``stock=True``.
+        """
+        self.listeners.append(callback)
+        if stock:
+            self.stock_listeners.append(callback)
+
+    def invalidate(self, product_ids=(), stock_only=False):
+        """Drop cached entries after products change; ``stock_only`` keeps derived entries"""
+        self.backend.delete_many([f'product:{product_id}' for product_id in product_ids])
+        if not stock_only:
+            self.backend.bump_generation()
+        for callback in self.stock_listeners if stock_only else self.listeners:
+            callback(product_ids)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        namespaces = sorted(set(self.hits) | set(self.misses))
+        return {namespace: {'hits': self.hits[namespace], 'misses': self.misses[namespace]}
+                for namespace in namespaces}
+
+
+def mark_products_changed(session, product_ids, stock_only=False):
+    """Record products changed outside the ORM so the cache drops them on commit"""
+    key = STOCK_CHANGED_PRODUCTS_KEY if stock_only else CHANGED_PRODUCTS_KEY
+    session.info.setdefault(key, set()).update(product_ids)
+
+
+def _changed_columns(product):
+    return {attr.key for attr in inspect(product).attrs if attr.history.has_changes()}
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_products(session, flush_context):
+    changed = [obj.id for obj in session.new if isinstance(obj, Product)]
+    changed += [obj.id for obj in session.deleted if isinstance(obj, Product)]
+    stock_changed = []
+    for obj in session.dirty:
+        if isinstance(obj, Product) and session.is_modified(obj):
+            (stock_changed if _changed_columns(obj) <= STOCK_COLUMNS else changed).append(obj.id)
+    if changed:
+        mark_products_changed(session, changed)
+    if stock_changed:
+        mark_products_changed(session, stock_changed, stock_only=True)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed_products(session):
+    changed = session.info.pop(CHANGED_PRODUCTS_KEY, None) or set()
+    stock_changed = (session.info.pop(STOCK_CHANGED_PRODUCTS_KEY, None) or set()) - changed
+    if (changed or stock_changed) and has_app_context():
+        cache = current_app.extensions.get('catalog_cache')
+        if cache is not None:
+            if changed:
+                cache.invalidate(changed)
+            if stock_changed:
+                cache.invalidate(stock_changed, stock_only=True)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_products(session):
+    session.info.pop(CHANGED_PRODUCTS_KEY, None)
+    session.info.pop(STOCK_CHANGED_PRODUCTS_KEY, None)
@@ -0,0 +1,206 @@
+"""Streaming bulk import and export of the product catalog.
+
+Supplier feeds are CSV or JSON Lines files with one product per row, keyed on
+``sku``.  Rows are read lazily and processed in fixed-size chunks, so memory
+use depends on the chunk size, not the file size.  Each chunk is written with
+one bulk INSERT for new SKUs and one bulk UPDATE for known ones, instead of
+an ORM object per row.  The chunk's search index rows and cache invalidations
+are committed in the same transaction.  Exports stream rows from a cursor in
+the same formats, so a file exported here can be imported again unchanged.
+"""
+import csv
+import json
+import time
+from itertools import islice
+
+from sqlalchemy import insert, select, update
+
+from catalog_cache import mark_products_changed
+from models import db, Product
+from search import INDEXED_FIELDS, index_products
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 20
+
+FIELDS = ('sku', 'name', 'description', 'price', 'stock', 'category', 'image_url')
+FORMATS = ('csv', 'jsonl')
+
+_CONVERTERS = {
+    'sku': str,
+    'name': str,
+    'description': str,
+    'price': float,
+    'stock': int,
+    'category': str,
+    'image_url': str,
+}
+
+
+class RowError(ValueError):
+    pass
+
+
+def detect_format(filename):
+    for fmt in FORMATS:
+        if filename.lower().endswith('.' + fmt):
+            return fmt
+    if filename.lower().endswith('.json'):
+        return 'jsonl'
+    raise ValueError(f'Cannot tell the format of {filename}; pass --format')
+
+
+def read_rows(file, fmt):
+    """Yield ``(line_number, dict)`` pairs from a CSV or JSON Lines file"""
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(file, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, RowError(f'invalid JSON ({e})')
+
+
+def normalize(row):
+    """Convert a raw feed row to Product column values; raises RowError if it is unusable"""
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError('expected an object')
+    values = {}
+    for field, convert in _CONVERTERS.items():
+        raw = row.get(field)
+        if raw is None or (isinstance(raw, str) and not raw.strip() and field != 'description'):
+            continue
+        try:
+            values[field] = convert(raw.strip() if isinstance(raw, str) else raw)
+        except (TypeError, ValueError):
+            raise RowError(f'invalid {field} {raw!r}')
+    if not values.get('sku'):
+        raise RowError('missing sku')
+    if len(values['sku']) > Product.sku.type.length:
+        raise RowError('sku is too long')
+    if values.get('price', 0) < 0 or values.get('stock', 0) < 0:
+        raise RowError('price and stock cannot be negative')
+    return values
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _import_chunk(rows):
+    """Upsert one chunk of normalized rows keyed on sku; returns (inserted, updated, errors)"""
+    by_sku = {}
+    for line_number, values in rows:
+        by_sku[values['sku']] = {**by_sku.get(values['sku'], {}), **values}
+
+    existing = dict(db.session.execute(
+        select(Product.sku, Product.id).where(Product.sku.in_(list(by_sku)))
+    ).all())
+
+    new_rows, errors = [], []
+    for sku, values in by_sku.items():
+        if sku in existing:
+            continue
+        if 'name' not in values or 'price' not in values:
+            errors.append(f'sku {sku}: new products need a name and a price')
+            continue
+        new_rows.append({'description': '', 'stock': 0, **values})
+    changed_rows = [{'id': existing[sku], **values} for sku, values in by_sku.items() if sku in existing]
+
+    if new_rows:
+        db.session.execute(insert(Product), new_rows)
+    if changed_rows:
+        db.session.execute(update(Product), changed_rows)
+
+    reindex = [row['sku'] for row in new_rows + changed_rows if row.keys() & set(INDEXED_FIELDS)]
+    if reindex:
+        indexed = db.session.execute(
+            select(Product.id, *[getattr(Product, field) for field in INDEXED_FIELDS])
+            .where(Product.sku.in_(reindex))
+        ).all()
+        index_products(db.session.connection(), indexed)
+
+    ids = list(existing.values())
+    if new_rows:
+        ids += db.session.execute(
+            select(Product.id).where(Product.sku.in_([row['sku'] for row in new_rows]))).scalars().all()
+    mark_products_changed(db.session, ids)
+    return len(new_rows), len(changed_rows), errors
+
+
+def import_products(file, fmt, chunk_size=CHUNK_SIZE, progress=None):
+    """Stream products from ``file`` into the catalog, committing once per chunk.
+
+    Rows that cannot be used are skipped and reported.  ``progress`` is called
+    after every chunk with the running stats.  Returns the final stats dict.
+    """
+    stats = {'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'errors': [], 'seconds': 0.0}
+    started = time.perf_counter()
+
+    def report(message):
+        stats['skipped'] += 1
+        if len(stats['errors']) < MAX_REPORTED_ERRORS:
+            stats['errors'].append(message)
+
+    for chunk in chunked(read_rows(file, fmt), chunk_size):
+        rows = []
+        for line_number, raw in chunk:
+            try:
+                rows.append((line_number, normalize(raw)))
+            except RowError as e:
+                report(f'line {line_number}: {e}')
+        stats['rows'] += len(chunk)
+
+        inserted, updated, errors = _import_chunk(rows) if rows else (0, 0, [])
+        db.session.commit()
+        db.session.expunge_all()
+        stats['inserted'] += inserted
+        stats['updated'] += updated
+        for error in errors:
+            report(error)
+        stats['seconds'] = time.perf_counter() - started
+        if progress is not None:
+            progress(stats)
+    return stats
+
+
+def _csv_writer(file):
+    writer = csv.DictWriter(file, fieldnames=FIELDS)
+    writer.writeheader()
+    return writer.writerow
+
+
+def _jsonl_writer(file):
+    def write(row):
+        file.write(json.dumps(row) + '\n')
+    return write
+
+
+def export_products(file, fmt, chunk_size=CHUNK_SIZE, progress=None):
+    """Stream every product to ``file`` in id order; returns the stats dict"""
+    write = _csv_writer(file) if fmt == 'csv' else _jsonl_writer(file)
+    stats = {'rows': 0, 'seconds': 0.0}
+    started = time.perf_counter()
+    result = db.session.execute(
+        select(*[getattr(Product, field) for field in FIELDS])
+        .order_by(Product.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    for partition in result.mappings().partitions():
+        for row in partition:
+            write(dict(row))
+        stats['rows'] += len(partition)
+        stats['seconds'] = time.perf_counter() - started
+        if progress is not None:
+            progress(stats)
+    return stats
@@ -0,0 +1,142 @@
+"""Order placement.
+
+``place_order()`` turns a user's cart into an ``Order`` with its
+``OrderItem`` rows in one short transaction.  Stock is taken with one
+conditional statement per product::
+
+    UPDATE product SET stock = stock - :qty WHERE id = :id AND stock >= :qty
+
+so two checkouts racing for the last unit cannot both succeed; the loser's
+update matches no row and its whole order is rolled back.  Nothing is read
+and then written back, no ``SELECT ... FOR UPDATE`` is held while the order
+is built, and products are always updated in id order so concurrent
+checkouts take their row locks in the same order and cannot deadlock.
+The cart is emptied first, with one ``DELETE`` of the rows that were read:
+when the same cart is submitted twice, the second checkout deletes fewer
+rows than it read and fails with ``CheckoutError`` before taking any stock.
+The total is priced in integer cents from the prices the stock update
+read (see pricing.py).  Follow-up work is queued in the outbox (see
+outbox.py) in the same commit.
+"""
+import time
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+
+import counters
+from catalog_cache import mark_products_changed
+from models import db, CartItem, Order, OrderItem, Product
+from outbox import enqueue
+from pricing import price_subtotal, to_cents
+
+PLACE_ORDER_RETRIES = 3
+RETRY_BACKOFF = 0.05
+
+
+class CheckoutError(Exception):
+    """The order could not be placed; nothing was written"""
+
+
+class CartChanged(CheckoutError):
+    def __init__(self):
+        super().__init__('Your cart changed while checking out. Please review it and try again.')
+
+
+class OutOfStock(CheckoutError):
+    def __init__(self, names):
+        self.names = sorted(names)
+        super().__init__('Not enough stock available for ' + ', '.join(self.names))
+
+
+def _take_stock(quantities):
+    """Decrement stock for ``{product_id: quantity}``; returns ``{product_id: price}`` or raises OutOfStock"""
+    returning = db.session.get_bind().dialect.update_returning
+    prices, short = {}, []
+    for product_id in sorted(quantities):
+        stmt = (update(Product)
+                .where(Product.id == product_id, Product.stock >= quantities[product_id])
+                .values(stock=Product.stock - quantities[product_id])
+                .execution_options(synchronize_session=False))
+        if returning:
+            price = db.session.execute(stmt.returning(Product.price)).scalar()
+            if price is None:
+                short.append(product_id)
+            else:
+                prices[product_id] = price
+        elif db.session.execute(stmt).rowcount != 1:
+            short.append(product_id)
+
+    if short:
+        names = db.session.execute(select(Product.name).where(Product.id.in_(short))).scalars()
+        raise OutOfStock(names)
+    if not returning:
+        prices = dict(db.session.execute(
+            select(Product.id, Product.price).where(Product.id.in_(list(quantities)))).all())
+    return prices
+
+
+def _empty_cart(user_id, cart_items):
+    """Delete the cart rows that were read; raises CartChanged if another checkout got to them first"""
+    ids = [item.id for item in cart_items]
+    deleted = db.session.execute(delete(CartItem).where(CartItem.user_id == user_id, CartItem.id.in_(ids))).rowcount
+    if deleted != len(ids):
+        raise CartChanged()
+    # A Core delete bypasses the flush hook that keeps cart_count
+    counters.adjust(user_id, cart_count=-deleted)
+
+
+def _create_order(user_id, promo):
+    cart_items = CartItem.query.filter_by(user_id=user_id).all()
+    if not cart_items:
+        raise CheckoutError('Your cart is empty!')
+    _empty_cart(user_id, cart_items)
+
+    quantities = {item.product_id: item.quantity for item in cart_items}
+    prices = _take_stock(quantities)
+    # Only stock changed, so cached listings and related products stay valid
+    mark_products_changed(db.session, quantities, stock_only=True)
+
+    subtotal_cents = sum(to_cents(prices[product_id]) * quantity for product_id, quantity in quantities.items())
+    order = Order(user_id=user_id, total=price_subtotal(subtotal_cents, promo)['total'], status='pending')
+    order.order_items = [OrderItem(product_id=product_id, quantity=quantity, price=prices[product_id])
+                         for product_id, quantity in sorted(quantities.items())]
+    db.session.add(order)
+    db.session.flush()
+
+    # Confirmation, inventory sync and analytics run from the outbox after commit
+    enqueue('order.placed', {
+        'order_id': order.id,
+        'user_id': user_id,
+        'total': order.total,
+        'items': [{'product_id': item.product_id, 'quantity': item.quantity, 'price': item.price}
+                  for item in order.order_items],
+    })
+    return order
+
+
+def place_order(user_id, promo=None, retries=PLACE_ORDER_RETRIES):
+    """Place an order for everything in a user's cart and commit it.
+
+    ``promo`` is the ``PromoRule`` to apply, if any.  Raises
+    ``CheckoutError`` (``OutOfStock`` when an item ran out, ``CartChanged``
+    when the cart was checked out or edited concurrently) after rolling
+    back.  Lock timeouts and serialization failures are retried a few times
+    with a short backoff before being re-raised.
+    """
+    for attempt in range(retries + 1):
+        try:
+            order = _create_order(user_id, promo)
+            db.session.commit()
+            return order
+        except CheckoutError:
+            db.session.rollback()
+            raise
+        except StaleDataError:
+            db.session.rollback()
+            raise CartChanged()
+        except OperationalError:
+            db.session.rollback()
+            if attempt == retries:
+                raise
+            time.sleep(RETRY_BACKOFF * (attempt + 1))
@@ -0,0 +1,123 @@
+"""Denormalized per-user counters.
+
+``User.cart_count``, ``wishlist_count``, ``order_count`` and ``total_spent``
+are kept up to date in the same transaction as the rows they count, so the
+cart badge and the dashboard read them with ``current()``, a primary-key
+lookup of the user row, instead of running aggregates on every page.  They
+are read from the database rather than from the cached identity, so every
+worker shows the same figures as soon as the change commits.
+
+ORM inserts and deletes of ``CartItem``, ``WishlistItem`` and ``Order`` are
+counted by a flush hook.  Code that writes those tables with Core statements
+(see upserts.py) must call ``adjust()`` or ``recount_cart()`` itself.
+``reconcile()`` recomputes every counter from the source tables in bulk.
+"""
+from collections import defaultdict
+
+from flask import g, has_request_context
+from sqlalchemy import event, func, inspect, or_, select, update
+from sqlalchemy.orm import Session
+
+from models import db, User, CartItem, WishlistItem, Order
+
+RECONCILE_BATCH_SIZE = 10000
+COUNTER_COLUMNS = ('cart_count', 'wishlist_count', 'order_count', 'total_spent')
+
+
+def current(user_id):
+    """A user's counters as ``{name: value}``, read once per request"""
+    memo = g.setdefault('_user_counters', {}) if has_request_context() else {}
+    if user_id not in memo:
+        row = db.session.execute(
+            select(*[getattr(User, name) for name in COUNTER_COLUMNS]).where(User.id == user_id)
+        ).first()
+        memo[user_id] = dict(row._mapping) if row else dict.fromkeys(COUNTER_COLUMNS, 0)
+    return memo[user_id]
+
+
+def _expire_user(session, user_id, names):
+    # The counters changed in SQL; reload them here and in current()
+    if has_request_context():
+        g.get('_user_counters', {}).pop(user_id, None)
+    user = session.identity_map.get(inspect(User).identity_key_from_primary_key((user_id,)))
+    if user is not None:
+        session.expire(user, list(names))
+
+
+def adjust(user_id, session=None, connection=None, **deltas):
+    """Add ``deltas`` (e.g. ``cart_count=1``) to a user's counters in the current transaction"""
+    session = session or db.session
+    values = {name: getattr(User, name) + delta for name, delta in deltas.items() if delta}
+    if not values:
+        return
+    (connection or session).execute(update(User).where(User.id == user_id).values(**values))
+    _expire_user(session, user_id, values)
+
+
+def recount_cart(user_id):
+    """Set a user's cart_count from the cart table (used when a write cannot report inserts)"""
+    count = select(func.count()).where(CartItem.user_id == user_id).scalar_subquery()
+    db.session.execute(update(User).where(User.id == user_id).values(cart_count=count))
+    _expire_user(db.session, user_id, ['cart_count'])
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_flushed_rows(session, flush_context):
+    deltas = defaultdict(lambda: defaultdict(int))
+    for obj, sign in [(obj, 1) for obj in session.new] + [(obj, -1) for obj in session.deleted]:
+        if isinstance(obj, CartItem):
+            deltas[obj.user_id]['cart_count'] += sign
+        elif isinstance(obj, WishlistItem):
+            deltas[obj.user_id]['wishlist_count'] += sign
+        elif isinstance(obj, Order):
+            deltas[obj.user_id]['order_count'] += sign
+            deltas[obj.user_id]['total_spent'] += sign * (obj.total or 0)
+    for obj in session.dirty:
+        if isinstance(obj, Order):
+            history = inspect(obj).attrs.total.history
+            if history.deleted and history.added:
+                deltas[obj.user_id]['total_spent'] += (history.added[0] or 0) - (history.deleted[0] or 0)
+
+    if not deltas:
+        return
+    connection = session.connection()
+    for user_id, user_deltas in deltas.items():
+        adjust(user_id, session=session, connection=connection, **user_deltas)
+
+
+def _expected_counters():
+    return {
+        'cart_count': select(func.count()).where(CartItem.user_id == User.id).scalar_subquery(),
+        'wishlist_count': select(func.count()).where(WishlistItem.user_id == User.id).scalar_subquery(),
+        'order_count': select(func.count()).where(Order.user_id == User.id).scalar_subquery(),
+        'total_spent': select(func.coalesce(func.sum(Order.total), 0))
+        .where(Order.user_id == User.id).scalar_subquery(),
+    }
+
+
+def reconcile(batch_size=RECONCILE_BATCH_SIZE):
+    """Recompute every user's counters in id-range batches; returns the number of users repaired"""
+    expected = _expected_counters()
+    drifted = or_(
+        User.cart_count != expected['cart_count'],
+        User.wishlist_count != expected['wishlist_count'],
+        User.order_count != expected['order_count'],
+        func.abs(User.total_spent - expected['total_spent']) > 0.005,
+    )
+    max_id = db.session.execute(select(func.max(User.id))).scalar() or 0
+    repaired = 0
+    for low in range(0, max_id + 1, batch_size):
+        user_ids = db.session.execute(
+            select(User.id).where(User.id >= low, User.id < low + batch_size, drifted)
+        ).scalars().all()
+        if not user_ids:
+            continue
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(user_ids))
+            .values(**expected)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        repaired += len(user_ids)
+    return repaired
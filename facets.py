@@ -0,0 +1,276 @@
+"""Faceted browsing backed by an in-memory bitmap index.
+
+Every product gets a slot number, assigned in ``(created_at, id)`` order.
+Each facet value (a category, a price bucket, "in stock") is a Python int
+used as a bitset over those slots.  A filter is a bitwise AND, a facet count
+is ``int.bit_count()`` of that AND, and walking the set bits from the top
+lists the matches newest first.  No query runs per request.
+
+The index is built with a single query, always on the primary database
+(see replicas.py), by a background thread that each process starts when it
+serves its first request.  After that it follows product changes
+incrementally: the catalog cache reports changed product ids after each
+commit, and those rows are re-read in one query before the next lookup.  It
+is also rebuilt every ``FACET_INDEX_TTL`` seconds to pick up changes
+committed by other processes.  Only one thread refreshes at a time; the
+others keep answering from the current bitsets meanwhile.
+"""
+import threading
+import time
+from collections import defaultdict
+from itertools import islice
+
+from sqlalchemy import select
+
+from models import db, Product
+from pagination import Page
+from replicas import primary_reads
+
+# (key, label, lower bound inclusive, upper bound exclusive)
+PRICE_BUCKETS = (
+    ('0-50', 'Under $50', 0, 50),
+    ('50-100', '$50 - $100', 50, 100),
+    ('100-250', '$100 - $250', 100, 250),
+    ('250-500', '$250 - $500', 250, 500),
+    ('500-1000', '$500 - $1,000', 500, 1000),
+    ('1000-', '$1,000 and up', 1000, None),
+)
+PRICE_BUCKET_KEYS = tuple(key for key, _, _, _ in PRICE_BUCKETS)
+
+_COLUMNS = (Product.id, Product.category, Product.price, Product.stock)
+
+
+def price_bucket(price):
+    for key, _, low, high in PRICE_BUCKETS:
+        if (price or 0) >= low and (high is None or (price or 0) < high):
+            return key
+    return PRICE_BUCKETS[0][0]
+
+
+def _facet_values(row):
+    return row.category or None, price_bucket(row.price), (row.stock or 0) > 0
+
+
+def _slots_descending(bits):
+    """Yield the set bit positions of ``bits``, highest first"""
+    digits = format(bits, 'b')
+    top = len(digits) - 1
+    position = digits.find('1')
+    while position != -1:
+        yield top - position
+        position = digits.find('1', position + 1)
+
+
+class FacetIndex:
+    """Flask extension keeping bitmap facet counts for category, price bucket and stock"""
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._warming = False
+        self._built_at = None
+        self._stale = set()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FACET_INDEX_TTL', 300)
+        self.ttl = app.config['FACET_INDEX_TTL']
+        self.app = app
+
+        app.before_request(self._warm_up)
+        app.extensions['facets'] = self
+        catalog_cache = app.extensions.get('catalog_cache')
+        if catalog_cache is not None:
+            catalog_cache.subscribe(self.invalidate, stock=True)
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.register_gauge('shopease_facet_index_products', 'Products in the facet index',
+                                   lambda: self._all.bit_count())
+
+    def _reset(self):
+        self._slots = {}            # product id -> slot
+        self._ids = []              # slot -> product id (None once deleted)
+        self._values = []           # slot -> (category, price bucket, in stock)
+        self._all = 0
+        self._in_stock = 0
+        self._categories = {}
+        self._prices = {}
+
+    # Maintenance
+    def _set(self, slot, values):
+        bit = 1 << slot
+        category, bucket, in_stock = values
+        self._all |= bit
+        self._categories[category] = self._categories.get(category, 0) | bit
+        self._prices[bucket] = self._prices.get(bucket, 0) | bit
+        if in_stock:
+            self._in_stock |= bit
+        self._values[slot] = values
+
+    def _clear(self, slot):
+        values = self._values[slot]
+        if values is None:
+            return
+        mask = ~(1 << slot)
+        category, bucket, _ = values
+        self._all &= mask
+        self._in_stock &= mask
+        self._categories[category] &= mask
+        if not self._categories[category]:
+            del self._categories[category]
+        self._prices[bucket] &= mask
+        self._values[slot] = None
+
+    def _place(self, row):
+        values = _facet_values(row)
+        slot = self._slots.get(row.id)
+        if slot is None:
+            # New products are the newest, so appending keeps slots in listing order
+            slot = self._slots[row.id] = len(self._ids)
+            self._ids.append(row.id)
+            self._values.append(None)
+        elif self._values[slot] == values:
+            return
+        else:
+            self._clear(slot)
+        self._set(slot, values)
+
+    def _warm_up(self):
+        if self._warming:
+            return
+        with self._lock:
+            if self._warming:
+                return
+            self._warming = True
+        threading.Thread(target=self._build_in_background, name='facet-index-build', daemon=True).start()
+
+    def _build_in_background(self):
+        with self.app.app_context():
+            self._refresh()
+
+    def rebuild(self):
+        with self._refreshing:
+            self._rebuild()
+
+    def _rebuild(self):
+        with self._lock:
+            # Anything invalidated from here on is re-read after the build
+            self._stale.clear()
+        with primary_reads():
+            rows = db.session.execute(select(*_COLUMNS).order_by(Product.created_at, Product.id)).all()
+
+        # Set bits in byte buffers and convert each once; OR-ing bit by bit
+        # into a growing int would copy it for every product
+        buffers = defaultdict(lambda: bytearray((len(rows) + 7) // 8))
+        values = []
+        for slot, row in enumerate(rows):
+            value = _facet_values(row)
+            values.append(value)
+            category, bucket, in_stock = value
+            for key in (('all',), ('category', category), ('price', bucket)) + ((('in_stock',),) if in_stock else ()):
+                buffers[key][slot >> 3] |= 1 << (slot & 7)
+        bitsets = {key: int.from_bytes(buffer, 'little') for key, buffer in buffers.items()}
+
+        with self._lock:
+            self._reset()
+            self._ids = [row.id for row in rows]
+            self._slots = {product_id: slot for slot, product_id in enumerate(self._ids)}
+            self._values = values
+            self._all = bitsets.get(('all',), 0)
+            self._in_stock = bitsets.get(('in_stock',), 0)
+            self._categories = {key[1]: bits for key, bits in bitsets.items() if key[0] == 'category'}
+            self._prices = {key[1]: bits for key, bits in bitsets.items() if key[0] == 'price'}
+            self._built_at = time.monotonic()
+
+    def invalidate(self, product_ids):
+        """Mark products as changed; they are re-read before the next lookup"""
+        with self._lock:
+            self._stale.update(product_ids)
+
+    def _refresh(self):
+        if self._built_at is None:
+            # Nothing to serve yet: wait for whichever thread builds it first
+            with self._refreshing:
+                if self._built_at is None:
+                    self._rebuild()
+            return
+        if not self._refreshing.acquire(blocking=False):
+            # Another thread is refreshing; answer from the current bitsets meanwhile
+            return
+        try:
+            if time.monotonic() - self._built_at > self.ttl:
+                self._rebuild()
+            else:
+                self._apply_changes()
+        finally:
+            self._refreshing.release()
+
+    def _apply_changes(self):
+        with self._lock:
+            stale, self._stale = self._stale, set()
+        if not stale:
+            return
+        with primary_reads():
+            rows = db.session.execute(select(*_COLUMNS).where(Product.id.in_(stale))).all()
+        with self._lock:
+            for row in rows:
+                self._place(row)
+            for product_id in stale - {row.id for row in rows}:
+                slot = self._slots.pop(product_id, None)
+                if slot is not None:
+                    self._clear(slot)
+                    self._ids[slot] = None
+
+    # Lookups
+    def _filters(self, category, price, in_stock):
+        """Bitsets for each active filter, keyed by facet name"""
+        filters = {}
+        if category:
+            filters['category'] = self._categories.get(category, 0)
+        if price in PRICE_BUCKET_KEYS:
+            filters['price'] = self._prices.get(price, 0)
+        if in_stock:
+            filters['in_stock'] = self._in_stock
+        return filters
+
+    def _matching(self, filters, skip=None):
+        bits = self._all
+        for name, mask in filters.items():
+            if name != skip:
+                bits &= mask
+        return bits
+
+    def counts(self, category=None, price=None, in_stock=False):
+        """Facet values with the number of products each would show.
+
+        Each facet is counted against the other active filters but not its
+        own, so every option shows what selecting it would return.
+        """
+        self._refresh()
+        with self._lock:
+            filters = self._filters(category, price, in_stock)
+            by_category = self._matching(filters, skip='category')
+            by_price = self._matching(filters, skip='price')
+            by_stock = self._matching(filters, skip='in_stock')
+            return {
+                'total': self._matching(filters).bit_count(),
+                'categories': sorted((name, (bits & by_category).bit_count())
+                                     for name, bits in self._categories.items() if name),
+                'prices': [(key, label, (self._prices.get(key, 0) & by_price).bit_count())
+                           for key, label, _, _ in PRICE_BUCKETS],
+                'in_stock': (self._in_stock & by_stock).bit_count(),
+            }
+
+    def listing(self, category=None, price=None, in_stock=False, page=1, per_page=12):
+        """Return a Page of product ids matching the filters, newest first"""
+        self._refresh()
+        page = max(page, 1)
+        with self._lock:
+            bits = self._matching(self._filters(category, price, in_stock))
+            ids = self._ids
+        slots = islice(_slots_descending(bits), (page - 1) * per_page, page * per_page)
+        # A slot can be emptied by a concurrent refresh; that product is simply skipped
+        return Page([ids[slot] for slot in slots if ids[slot] is not None], bits.bit_count(), page, per_page)
@@ -0,0 +1,154 @@
+"""Carts for visitors who have not logged in.
+
+A guest's cart is a ``{product_id: quantity}`` mapping kept outside the
+database, so browsing and adding to the cart costs no writes.  By default it
+lives in Flask's signed session cookie (``GUEST_CART_BACKEND=session``).
+``memory`` keeps it in a per-process LRU and ``redis`` keeps it in Redis
+shared by all workers; both hold only a random cart id in the session.
+Every backend expires carts after ``GUEST_CART_TTL`` seconds.
+
+Products are read through the catalog cache, so rendering a guest cart
+usually runs no queries at all.  At login ``merge_into()`` adds the whole
+cart to the user's ``CartItem`` rows with one bulk upsert.
+"""
+import secrets
+import time
+from types import SimpleNamespace
+
+from flask import current_app, session
+
+from cart_service import CartError, apply_guest_cart_operations
+from catalog_cache import MISSING, LRUCache, RedisCache
+from upserts import increment_cart_items
+
+SESSION_KEY = 'guest_cart'
+
+
+def _products(product_ids):
+    return current_app.extensions['catalog_cache'].products(list(product_ids))
+
+
+class SessionCartStore:
+    """Keeps the cart itself in the signed session cookie"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def load(self):
+        stored = session.get(SESSION_KEY)
+        if not stored or stored.get('expires_at', 0) < time.time():
+            return {}
+        return {int(product_id): quantity for product_id, quantity in stored['items'].items()}
+
+    def save(self, quantities):
+        if not quantities:
+            session.pop(SESSION_KEY, None)
+            return
+        session[SESSION_KEY] = {
+            'items': {str(product_id): quantity for product_id, quantity in quantities.items()},
+            'expires_at': int(time.time() + self.ttl),
+        }
+
+
+class ServerCartStore:
+    """Keeps carts in a cache backend, keyed by a random id held in the session"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def load(self):
+        cart_id = session.get(SESSION_KEY)
+        if not cart_id:
+            return {}
+        quantities = self.backend.get(f'cart:{cart_id}')
+        return {} if quantities is MISSING else dict(quantities)
+
+    def save(self, quantities):
+        cart_id = session.get(SESSION_KEY)
+        if not quantities:
+            if cart_id:
+                self.backend.delete_many([f'cart:{cart_id}'])
+                session.pop(SESSION_KEY, None)
+            return
+        if not cart_id:
+            cart_id = session[SESSION_KEY] = secrets.token_urlsafe(16)
+        self.backend.set(f'cart:{cart_id}', dict(quantities))
+
+
+class GuestCart:
+    """Flask extension holding carts for anonymous visitors outside the database"""
+
+    def __init__(self, app=None):
+        self.store = None
+        self.max_items = 50
+        self.merged = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GUEST_CART_BACKEND', 'session')
+        app.config.setdefault('GUEST_CART_TTL', 7 * 24 * 3600)
+        app.config.setdefault('GUEST_CART_MAX_ITEMS', 50)
+        app.config.setdefault('GUEST_CART_MAX_CARTS', 100000)
+        app.config.setdefault('GUEST_CART_URL', app.config.get('CATALOG_CACHE_URL'))
+
+        backend = app.config['GUEST_CART_BACKEND']
+        ttl = app.config['GUEST_CART_TTL']
+        if backend == 'session':
+            self.store = SessionCartStore(ttl)
+        elif backend == 'memory':
+            self.store = ServerCartStore(LRUCache(app.config['GUEST_CART_MAX_CARTS'], ttl))
+        elif backend == 'redis':
+            self.store = ServerCartStore(RedisCache(app.config['GUEST_CART_URL'], ttl, prefix='shopease:guest:'))
+        else:
+            raise ValueError(f'Unknown GUEST_CART_BACKEND: {backend}')
+        self.max_items = app.config['GUEST_CART_MAX_ITEMS']
+
+        app.extensions['guest_cart'] = self
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.register_gauge('shopease_guest_carts_merged', 'Guest carts merged into user carts at login',
+                                   lambda: self.merged)
+
+    def quantities(self):
+        return self.store.load()
+
+    def count(self):
+        return len(self.store.load())
+
+    def items(self):
+        """Cart lines shaped like ``CartItem`` (``product_id``, ``product``, ``quantity``)"""
+        quantities = self.store.load()
+        return [SimpleNamespace(product_id=product.id, product=product, quantity=quantities[product.id])
+                for product in _products(quantities)]
+
+    def _save(self, quantities):
+        if len(quantities) > self.max_items:
+            raise CartError(f'Carts hold at most {self.max_items} different products until you log in')
+        self.store.save(quantities)
+
+    def add(self, product_id, quantity=1):
+        quantities = self.store.load()
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+        self._save(quantities)
+
+    def apply(self, operations):
+        """Apply a batch of cart operations (see ``cart_service``); raises ``CartError``"""
+        self._save(apply_guest_cart_operations(self.store.load(), operations, _products))
+
+    def merge_into(self, user_id):
+        """Add the guest cart to ``user_id``'s cart in the caller's transaction.
+
+        Call ``clear()`` once that transaction has committed.  Returns the
+        number of lines merged.
+        """
+        quantities = self.store.load()
+        # Skip products deleted since they were added
+        quantities = {product.id: quantities[product.id] for product in _products(quantities)}
+        if quantities:
+            increment_cart_items(user_id, quantities)
+            self.merged += 1
+        return len(quantities)
+
+    def clear(self):
+        self.store.save({})
@@ -0,0 +1,133 @@
+"""HTTP caching for catalog pages and static assets.
+
+Anonymous catalog pages are validated by the data they show: the ETag
+is a hash of each displayed product's id and ``updated_at``, plus whatever
+else the page depends on (pagination state, categories, the template
+sources).  The products come from the catalog cache, so a matching
+``If-None-Match`` is answered with a 304 before any template is rendered.
+These pages are ``public`` for ``HTTP_CACHE_MAX_AGE`` seconds, so browsers
+and a CDN can reuse them.
+
+Pages for logged-in users and for guests with a cart (cart badge, flashed
+messages) are never shared and are marked ``private, no-cache``.  ``url_for('static', ...)`` adds a
+content hash (``?v=...``) to every static URL.  Those URLs are served as
+``immutable`` for a year, and a changed file simply gets a new URL.
+"""
+import hashlib
+import os
+from datetime import timezone
+
+from flask import make_response, request, session
+from flask_login import current_user
+
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+def _digest(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+
+def page_state(page):
+    """Everything about a Page/KeysetPage except its items, for use in a validator"""
+    return sorted((name, value) for name, value in vars(page).items() if name != 'items')
+
+
+class HTTPCache:
+    """Flask extension adding conditional GET to catalog pages and fingerprinted static URLs"""
+
+    def __init__(self, app=None):
+        self.max_age = 60
+        self._templates_digest = None
+        self._static_hashes = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('HTTP_CACHE_MAX_AGE', 60)
+        self.max_age = app.config['HTTP_CACHE_MAX_AGE']
+        self.app = app
+        app.url_defaults(self._fingerprint_static_url)
+        app.after_request(self._apply_cache_policy)
+        app.extensions['http_cache'] = self
+
+    # Static assets
+    def static_hash(self, filename):
+        path = os.path.join(self.app.static_folder, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        digest = self._static_hashes.get(key)
+        if digest is None:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+            self._static_hashes[key] = digest
+        return digest
+
+    def _fingerprint_static_url(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            digest = self.static_hash(values['filename'])
+            if digest:
+                values['v'] = digest
+
+    # Catalog pages
+    def templates_digest(self):
+        """Hash of every template's source, so a deploy that changes markup changes every ETag"""
+        if self._templates_digest is None:
+            env = self.app.jinja_env
+            sources = [(name, env.loader.get_source(env, name)[0]) for name in sorted(env.list_templates())]
+            self._templates_digest = _digest(sources)
+        return self._templates_digest
+
+    def shareable(self):
+        """True if the response cannot depend on who is asking"""
+        if current_user.is_authenticated or session.get('_flashes'):
+            return False
+        # A guest's cart badge is per visitor too
+        guest_cart = self.app.extensions.get('guest_cart')
+        return guest_cart is None or not guest_cart.count()
+
+    def catalog_response(self, render, products, *depends_on):
+        """Render a catalog page, or answer 304 if the client's copy is still current.
+
+        ``products`` are the products the page shows (anything with ``id``,
+        ``created_at`` and ``updated_at``); ``depends_on`` lists any other
+        values the page is rendered from.
+        """
+        if not self.shareable():
+            return make_response(render())
+
+        etag = _digest((request.full_path, self.templates_digest(),
+                        [(product.id, product.updated_at) for product in products], depends_on))
+        timestamps = [product.updated_at or product.created_at for product in products]
+        last_modified = max((stamp for stamp in timestamps if stamp), default=None)
+        if last_modified is not None:
+            last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+        # Last-Modified is informational only: a page can change by losing a
+        # product without any timestamp moving forward, so only the ETag can
+        # prove a copy is current
+        not_modified = request.if_none_match.contains(etag)
+
+        response = make_response('' if not_modified else render(), 304 if not_modified else 200)
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        response.vary.add('Cookie')
+        return response
+
+    # Default policy for everything else
+    def _apply_cache_policy(self, response):
+        if request.endpoint == 'static':
+            if request.args.get('v'):
+                response.cache_control.no_cache = None
+                response.cache_control.public = True
+                response.cache_control.max_age = STATIC_MAX_AGE
+                response.cache_control.immutable = True
+        elif 'Cache-Control' not in response.headers:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        return response
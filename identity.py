@@ -0,0 +1,131 @@
+"""Cached user records for Flask-Login.
+
+Flask-Login resolves ``current_user`` on every authenticated request.
+``IdentityCache.load()`` answers from a cache of ``CachedUser`` snapshots:
+the user's columns without the password hash, so a typical page for a
+logged-in user does not load the user row.  The denormalized cart, wishlist
+and order counters are left out as well: they change with every cart click,
+and a cached copy would show other workers' pages a stale badge, so they are
+read on demand with ``counters.current()``.
+
+The cache must never show a user older than the database.  Any committed
+change to a user row drops that user's entry: ORM updates are caught by a
+flush hook, and code changing users with Core statements calls
+``mark_users_changed()``.  If the current request's user changed, it is
+reloaded on its next access.  Logging out drops the entry as well.  With
+the in-process backend, changes committed by other processes show up within
+``IDENTITY_CACHE_TTL`` seconds; the Redis backend is shared by every worker
+and is dropped for all of them at once.
+"""
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+from flask import current_app, g, has_app_context, has_request_context
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from catalog_cache import MISSING, LRUCache, NullCache, RedisCache
+from models import db, User
+from replicas import primary_reads
+
+CHANGED_USERS_KEY = 'identity_changed_user_ids'
+_EXCLUDED_COLUMNS = ('password', 'cart_count', 'wishlist_count', 'order_count', 'total_spent')
+
+
+class CachedUser(UserMixin, SimpleNamespace):
+    """Detached copy of a user's columns, minus the password hash and counters"""
+
+    @classmethod
+    def from_model(cls, user):
+        return cls(**{column.key: getattr(user, column.key) for column in User.__table__.columns
+                      if column.key not in _EXCLUDED_COLUMNS})
+
+
+class IdentityCache:
+    """Flask extension resolving logged-in users from a cache instead of the database"""
+
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE_BACKEND', 'memory')
+        app.config.setdefault('IDENTITY_CACHE_TTL', 60)
+        app.config.setdefault('IDENTITY_CACHE_MAX_ENTRIES', 10000)
+        app.config.setdefault('IDENTITY_CACHE_URL', app.config.get('CATALOG_CACHE_URL'))
+
+        backend = app.config['IDENTITY_CACHE_BACKEND']
+        ttl = app.config['IDENTITY_CACHE_TTL']
+        if backend == 'memory':
+            self.backend = LRUCache(app.config['IDENTITY_CACHE_MAX_ENTRIES'], ttl)
+        elif backend == 'redis':
+            self.backend = RedisCache(app.config['IDENTITY_CACHE_URL'], ttl, prefix='shopease:identity:')
+        elif backend == 'none':
+            self.backend = NullCache()
+        else:
+            raise ValueError(f'Unknown IDENTITY_CACHE_BACKEND: {backend}')
+
+        app.extensions['identity_cache'] = self
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.register_gauge('shopease_identity_cache_hits', 'Logged-in users resolved from the cache',
+                                   lambda: self.hits)
+            metrics.register_gauge('shopease_identity_cache_misses', 'Logged-in users loaded from the database',
+                                   lambda: self.misses)
+
+    def load(self, user_id):
+        """The user as a ``CachedUser``, or None if there is no such user"""
+        key = f'user:{user_id}'
+        cached = self.backend.get(key)
+        if cached is not MISSING:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        # A replica may not have the latest row yet; nothing is cached without a backend
+        with nullcontext() if isinstance(self.backend, NullCache) else primary_reads():
+            user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        cached = CachedUser.from_model(user)
+        self.backend.set(key, cached)
+        return cached
+
+    def invalidate(self, user_ids):
+        """Drop cached users; the current request's user is reloaded on next access"""
+        user_ids = set(user_ids)
+        self.backend.delete_many([f'user:{user_id}' for user_id in user_ids])
+        if has_request_context():
+            user = g.get('_login_user')
+            if isinstance(user, CachedUser) and user.id in user_ids:
+                g.pop('_login_user')
+
+
+def mark_users_changed(session, user_ids):
+    """Record users changed outside the ORM so the cache drops them on commit"""
+    session.info.setdefault(CHANGED_USERS_KEY, set()).update(user_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_users(session, flush_context):
+    changed = [obj.id for obj in session.dirty if isinstance(obj, User) and session.is_modified(obj)]
+    changed += [obj.id for obj in session.deleted if isinstance(obj, User)]
+    if changed:
+        mark_users_changed(session, changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed_users(session):
+    changed = session.info.pop(CHANGED_USERS_KEY, None)
+    if changed and has_app_context():
+        cache = current_app.extensions.get('identity_cache')
+        if cache is not None:
+            cache.invalidate(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_users(session):
+    session.info.pop(CHANGED_USERS_KEY, None)
@@ -0,0 +1,318 @@
+"""Local thumbnail pipeline for product and static images.
+
+Templates call ``image_attrs(url, width)`` instead of pointing ``<img>`` at
+the full-size original.  It emits ``src``/``srcset``/``sizes`` attributes
+that reference ``/img/<token>/<width>`` at the configured ``IMAGE_WIDTHS``.
+The token is the signed source URL, so only images the app itself
+referenced can be fetched.
+
+The first request for a variant downloads the original into
+``IMAGE_STORE_DIR`` (remote URLs) or reads it from ``static/``.  It then
+resizes it (never enlarging) and stores the result, and every later request
+is a plain file send.  Browsers that accept WebP get WebP, others get a
+progressive JPEG.  Variants never change for a given URL, so they are served
+as immutable.  ``flask --app main generate-thumbnails`` does the same work
+for the whole catalog ahead of time.  The store is capped at
+``IMAGE_CACHE_MAX_BYTES``, and the least recently used files are evicted
+first.
+
+Pillow is optional; without it the helper falls back to the original URL.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+from flask import abort, current_app, redirect, request, send_file, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from markupsafe import Markup
+
+from catalog_cache import MISSING, LRUCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is only needed to generate thumbnails
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+MAX_SOURCE_BYTES = 20 * 1024 * 1024
+FAILURE_RETRY_SECONDS = 300
+MAX_FAILED_SOURCES = 4096
+TOUCH_INTERVAL = 3600
+VARIANT_MAX_AGE = 365 * 24 * 3600
+LOCK_STRIPES = 64
+
+
+class ImageError(Exception):
+    pass
+
+
+class ImagePipeline:
+    """Flask extension that stores originals, generates resized variants and serves them"""
+
+    def __init__(self, app=None):
+        self.widths = (80, 160, 320, 640, 960)
+        # Sources that could not be fetched or resized, skipped until their entry expires
+        self._failed = LRUCache(MAX_FAILED_SOURCES, FAILURE_RETRY_SECONDS)
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._store_bytes = None
+        self._size_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IMAGE_STORE_DIR', os.path.join(app.instance_path, 'images'))
+        app.config.setdefault('IMAGE_WIDTHS', (80, 160, 320, 640, 960))
+        app.config.setdefault('IMAGE_QUALITY', 80)
+        app.config.setdefault('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+        app.config.setdefault('IMAGE_FETCH_TIMEOUT', 10)
+
+        self.app = app
+        self.store_dir = app.config['IMAGE_STORE_DIR']
+        self.widths = tuple(sorted(int(width) for width in app.config['IMAGE_WIDTHS']))
+        self.quality = app.config['IMAGE_QUALITY']
+        self.max_bytes = app.config['IMAGE_CACHE_MAX_BYTES']
+        self.fetch_timeout = app.config['IMAGE_FETCH_TIMEOUT']
+
+        app.add_url_rule('/img/<token>/<int:width>', 'image_variant', self.serve)
+        app.add_template_global(self.image_attrs)
+        app.extensions['images'] = self
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    # Sources and URLs
+    def _serializer(self):
+        return URLSafeSerializer(current_app.secret_key, salt='image-source')
+
+    def _source_for(self, url):
+        """Normalize a template URL to a source ('static:<file>' or an http(s) URL), or None"""
+        if not url:
+            return None
+        static_prefix = current_app.static_url_path + '/'
+        if url.startswith(static_prefix):
+            return 'static:' + url[len(static_prefix):].split('?', 1)[0]
+        if url.startswith(('http://', 'https://')):
+            return url
+        return None
+
+    def token(self, source):
+        return self._serializer().dumps(source)
+
+    def image_attrs(self, url, width, sizes=None):
+        """``src``/``srcset``/``sizes`` attributes for an image displayed ``width`` CSS pixels wide"""
+        source = self._source_for(url) if self.enabled else None
+        if source is None:
+            return Markup('src="%s"') % (url or '')
+
+        # Enough candidates to cover 2x screens, plus one smaller fallback src
+        needed = [w for w in self.widths if w >= width * 2][:1] or [self.widths[-1]]
+        candidates = [w for w in self.widths if w <= needed[0]]
+        src_width = next((w for w in self.widths if w >= width), self.widths[-1])
+        token = self.token(source)
+        srcset = ', '.join(f'{url_for("image_variant", token=token, width=w)} {w}w' for w in candidates)
+        return Markup('src="%s" srcset="%s" sizes="%s"') % (
+            url_for('image_variant', token=token, width=src_width), srcset, sizes or f'{width}px')
+
+    # Storage
+    def _key(self, source):
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def _original_path(self, key):
+        return os.path.join(self.store_dir, 'originals', key[:2], key)
+
+    def _variant_path(self, key, width, fmt):
+        return os.path.join(self.store_dir, 'variants', key[:2], key, f'{width}.{fmt}')
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._account(len(data))
+
+    def _lock_for(self, key):
+        # A fixed set of striped locks keeps concurrent requests from doing the same work twice
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    def _read_source(self, source):
+        if source.startswith('static:'):
+            folder = os.path.realpath(current_app.static_folder)
+            path = os.path.realpath(os.path.join(folder, source[len('static:'):]))
+            if not path.startswith(folder + os.sep) or not os.path.isfile(path):
+                raise ImageError(f'No static image {source}')
+            with open(path, 'rb') as f:
+                return f.read()
+
+        req = urllib.request.Request(source, headers={'User-Agent': 'ShopEase image pipeline'})
+        try:
+            with urllib.request.urlopen(req, timeout=self.fetch_timeout) as response:
+                data = response.read(MAX_SOURCE_BYTES + 1)
+        except OSError as e:
+            raise ImageError(f'Could not fetch {source}: {e}')
+        if len(data) > MAX_SOURCE_BYTES:
+            raise ImageError(f'{source} is larger than {MAX_SOURCE_BYTES} bytes')
+        return data
+
+    def original(self, source):
+        """Path of the stored original, fetching it on first use"""
+        key = self._key(source)
+        path = self._original_path(key)
+        if not os.path.exists(path):
+            with self._lock_for(key):
+                if not os.path.exists(path):
+                    self._write(path, self._read_source(source))
+        return path
+
+    def _resize(self, original_path, width, fmt):
+        with Image.open(original_path) as img:
+            if img.format == 'JPEG':
+                # Let the decoder skip detail we are about to throw away
+                img.draft('RGB', (width, width * 4))
+            img = ImageOps.exif_transpose(img)
+            if fmt == 'jpeg' and img.mode != 'RGB':
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                rgba = img.convert('RGBA')
+                background.paste(rgba, mask=rgba.getchannel('A'))
+                img = background
+            elif img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA')
+            img.thumbnail((width, width * 4), Image.LANCZOS)
+            out = io.BytesIO()
+            if fmt == 'webp':
+                img.save(out, 'WEBP', quality=self.quality, method=4)
+            else:
+                img.save(out, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+            return out.getvalue()
+
+    def variant(self, source, width, fmt):
+        """Path of a resized variant, generating it on first use; raises ImageError"""
+        if not self.enabled:
+            raise ImageError('Pillow is not installed')
+        key = self._key(source)
+        path = self._variant_path(key, width, fmt)
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+        original_path = self.original(source)
+        with self._lock_for(f'{key}:{width}:{fmt}'):
+            if not os.path.exists(path):
+                try:
+                    data = self._resize(original_path, width, fmt)
+                except (OSError, ValueError, Image.DecompressionBombError) as e:
+                    raise ImageError(f'Could not resize {source}: {e}')
+                self._write(path, data)
+        self.evict_if_needed()
+        return path
+
+    def _touch(self, path):
+        # Eviction is least-recently-used by mtime; refresh it at most hourly
+        try:
+            if time.time() - os.path.getmtime(path) > TOUCH_INTERVAL:
+                os.utime(path)
+        except OSError:
+            pass
+
+    # Eviction
+    def _files(self):
+        for root, _, names in os.walk(self.store_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _account(self, size):
+        with self._size_lock:
+            if self._store_bytes is not None:
+                self._store_bytes += size
+
+    def store_bytes(self):
+        with self._size_lock:
+            if self._store_bytes is None:
+                self._store_bytes = sum(size for _, size, _ in self._files())
+            return self._store_bytes
+
+    def evict_if_needed(self):
+        if self.store_bytes() > self.max_bytes:
+            self.evict()
+
+    def evict(self, target_fraction=0.9):
+        """Delete least recently used files until the store is under the target size; returns files removed"""
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * target_fraction
+        removed = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._size_lock:
+            self._store_bytes = total
+        return removed
+
+    # Batch generation
+    def generate_all(self, source):
+        """Generate every width and format for one source; returns the number of variants written"""
+        written = 0
+        for width in self.widths:
+            for fmt in FORMATS:
+                if not os.path.exists(self._variant_path(self._key(source), width, fmt)):
+                    self.variant(source, width, fmt)
+                    written += 1
+        return written
+
+    # View
+    def serve(self, token, width):
+        try:
+            source = self._serializer().loads(token)
+        except BadSignature:
+            abort(404)
+        if width not in self.widths:
+            abort(404)
+
+        # Only browsers that name WebP explicitly get it; "*/*" does not count
+        fmt = 'webp' if any(mimetype == 'image/webp' for mimetype, quality in request.accept_mimetypes
+                            if quality) else 'jpeg'
+        key = self._key(source)
+        if self._failed.get(key) is not MISSING or not self.enabled:
+            return self._fallback(source)
+        # A variant can be evicted between variant() and send_file(); generate it once more
+        for _ in range(2):
+            try:
+                path = self.variant(source, width, fmt)
+            except ImageError as e:
+                logger.warning('%s', e)
+                self._failed.set(key, True)
+                return self._fallback(source)
+            try:
+                response = send_file(path, mimetype=FORMATS[fmt], max_age=VARIANT_MAX_AGE, conditional=True)
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            return self._fallback(source)
+
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add('Accept')
+        return response
+
+    def _fallback(self, source):
+        if source.startswith('static:'):
+            return redirect(url_for('static', filename=source[len('static:'):]))
+        return redirect(source)
@@ -1,12 +1,39 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, session, jsonify
+from flask import Flask, render_template, redirect, url_for, flash, request, session, jsonify, abort, \
+    Response, stream_with_context
 from flask_bootstrap5 import Bootstrap
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+import click
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 # from flask_wtf import CSRFProtect
-from werkzeug.security import generate_password_hash, check_password_hash
 from forms import RegisterForm, LoginForm
-from datetime import datetime
+from models import db, User, Product, CartItem, Order, OrderItem
+from search import search_products, rebuild_index
+from metrics import Metrics
+from catalog_cache import CatalogCache
+from facets import FacetIndex, PRICE_BUCKET_KEYS
+from pagination import KeysetPage, Page, keyset_paginate
+from http_cache import HTTPCache, page_state
+from images import ImagePipeline, ImageError
+from upserts import increment_cart_item, add_wishlist_item
+from cart_service import CartError, apply_cart_operations, cart_state, load_cart
+from checkout import CheckoutError, place_order
+from guest_cart import GuestCart
+from identity import IdentityCache
+from pricing import Pricing, seed_promo_codes
+from outbox import Outbox
+from replicas import ReadReplicas, read_only
+from passwords import PasswordHasher, PasswordHasherBusy
+import catalog_io
+import order_export
+import recommendations
+import sales_rollups
+import counters
+import schema
+from datetime import datetime, timedelta
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -15,10 +42,60 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'fallback_secret_key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['DATABASE_REPLICA_URIS'] = [uri.strip() for uri in os.environ.get('DATABASE_REPLICA_URIS', '').split(',')
+                                       if uri.strip()]
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+app.config['DB_POOL_SIZE'] = int(os.environ['DB_POOL_SIZE']) if os.environ.get('DB_POOL_SIZE') else None
+app.config['DB_MAX_OVERFLOW'] = int(os.environ['DB_MAX_OVERFLOW']) if os.environ.get('DB_MAX_OVERFLOW') else None
+app.config['DB_POOL_TIMEOUT'] = float(os.environ['DB_POOL_TIMEOUT']) if os.environ.get('DB_POOL_TIMEOUT') else None
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['REPORTS_TOKEN'] = os.environ.get('REPORTS_TOKEN')
+app.config['SLOW_REQUEST_MS'] = float(os.environ['SLOW_REQUEST_MS']) if os.environ.get('SLOW_REQUEST_MS') else None
+app.config['PAGINATION_MODE'] = os.environ.get('PAGINATION_MODE', 'keyset')
+app.config['CATALOG_CACHE_BACKEND'] = os.environ.get('CATALOG_CACHE_BACKEND', 'memory')
+app.config['CATALOG_CACHE_TTL'] = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+app.config['CATALOG_CACHE_MAX_ENTRIES'] = int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', 2048))
+app.config['CATALOG_CACHE_URL'] = os.environ.get('CATALOG_CACHE_URL')
+app.config['FACET_INDEX_TTL'] = int(os.environ.get('FACET_INDEX_TTL', 300))
+app.config['HTTP_CACHE_MAX_AGE'] = int(os.environ.get('HTTP_CACHE_MAX_AGE', 60))
+app.config['GUEST_CART_BACKEND'] = os.environ.get('GUEST_CART_BACKEND', 'session')
+app.config['GUEST_CART_TTL'] = int(os.environ.get('GUEST_CART_TTL', 7 * 24 * 3600))
+app.config['GUEST_CART_URL'] = os.environ.get('GUEST_CART_URL', app.config['CATALOG_CACHE_URL'])
+app.config['IDENTITY_CACHE_BACKEND'] = os.environ.get('IDENTITY_CACHE_BACKEND', 'memory')
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 60))
+app.config['IDENTITY_CACHE_URL'] = os.environ.get('IDENTITY_CACHE_URL', app.config['CATALOG_CACHE_URL'])
+app.config['PROMO_RULES_TTL'] = int(os.environ.get('PROMO_RULES_TTL', 60))
+app.config['RECOMMENDATIONS_STATE'] = os.environ.get(
+    'RECOMMENDATIONS_STATE', os.path.join(app.instance_path, 'recommendations.npz'))
+app.config['IMAGE_STORE_DIR'] = os.environ.get('IMAGE_STORE_DIR', os.path.join(app.instance_path, 'images'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 8))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+app.config['OUTBOX_SINK'] = os.environ.get('OUTBOX_SINK', 'log')
+app.config['OUTBOX_BATCH_SIZE'] = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+app.config['OUTBOX_MAX_ATTEMPTS'] = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+app.config['OUTBOX_WORKER_THREADS'] = int(os.environ.get('OUTBOX_WORKER_THREADS', 0))
 
 # Initialize extensions
-db = SQLAlchemy(app)
+metrics = Metrics(app)
+# Sets the engine options and replica binds, so it must come before db.init_app
+replicas = ReadReplicas(app)
+db.init_app(app)
 bootstrap = Bootstrap(app)
+catalog_cache = CatalogCache(app)
+facets = FacetIndex(app)
+http_cache = HTTPCache(app)
+guest_cart = GuestCart(app)
+identity_cache = IdentityCache(app)
+pricing = Pricing(app)
+images = ImagePipeline(app)
+outbox = Outbox(app)
+password_hasher = PasswordHasher(app)
 # csrf = CSRFProtect(app)  # Add CSRF protection
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -27,73 +104,9 @@ login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
 
-# Database Models
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(100), nullable=False, unique=True)
-    email = db.Column(db.String(150), unique=True, nullable=False)
-    password = db.Column(db.String(200), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-    # Relationships
-    orders = db.relationship('Order', backref='user', lazy=True)
-    cart_items = db.relationship('CartItem', backref='user', lazy=True)
-    wishlist_items = db.relationship('WishlistItem', backref='user', lazy=True)
-
-
-class Product(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(200), nullable=False)
-    description = db.Column(db.Text, nullable=False)
-    price = db.Column(db.Float, nullable=False)
-    image_url = db.Column(db.String(500))
-    stock = db.Column(db.Integer, default=0)
-    category = db.Column(db.String(100))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-    # Relationships
-    cart_items = db.relationship('CartItem', backref='product', lazy=True)
-    order_items = db.relationship('OrderItem', backref='product', lazy=True)
-    wishlist_items = db.relationship('WishlistItem', backref='product', lazy=True)
-
-
-class CartItem(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False, default=1)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-
-class Order(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    total = db.Column(db.Float, nullable=False)
-    status = db.Column(db.String(50), default='pending')
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-    # Relationships
-    order_items = db.relationship('OrderItem', backref='order', lazy=True)
-
-
-class OrderItem(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-    price = db.Column(db.Float, nullable=False)
-
-
-class WishlistItem(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return identity_cache.load(int(user_id))
 
 
 # Sample data function
@@ -167,12 +180,15 @@ def create_sample_data():
             }
         ]
 
-        for product_data in sample_products:
-            product = Product(**product_data)
+        for number, product_data in enumerate(sample_products, 1):
+            product = Product(sku=f'SE-{number}', **product_data)
             db.session.add(product)
 
         db.session.commit()
 
+    if seed_promo_codes(db.session):
+        db.session.commit()
+
 
 # Routes
 @app.route('/')
@@ -185,7 +201,19 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and check_password_hash(user.password, form.password.data):
+        try:
+            valid, new_hash = password_hasher.verify(user.password, form.password.data) if user else (False, None)
+        except PasswordHasherBusy:
+            flash('We are handling a lot of sign-ins right now. Please try again in a moment.', 'warning')
+            return render_template('login.html', form=form), 503
+        if valid:
+            if new_hash:
+                # Stored with outdated hash parameters; upgrade while we have the password
+                user.password = new_hash
+            # Anything added to the cart before logging in joins the user's cart
+            guest_cart.merge_into(user.id)
+            db.session.commit()
+            guest_cart.clear()
             login_user(user, remember=True)
             flash('Welcome back! You have successfully logged in.', 'success')
             next_page = request.args.get('next')
@@ -210,7 +238,11 @@ def register():
             flash('Username already taken. Please choose a different username.', 'danger')
             return render_template('register.html', form=form)
 
-        hashed_password = generate_password_hash(form.password.data)
+        try:
+            hashed_password = password_hasher.hash(form.password.data)
+        except PasswordHasherBusy:
+            flash('We are handling a lot of sign-ups right now. Please try again in a moment.', 'warning')
+            return render_template('register.html', form=form), 503
         new_user = User(
             username=form.username.data,
             email=form.email.data,
@@ -232,7 +264,9 @@ def register():
 @app.route('/logout')
 @login_required
 def logout():
+    user_id = current_user.id
     logout_user()
+    identity_cache.invalidate([user_id])
     flash('You have been successfully logged out.', 'info')
     return redirect(url_for('index'))
 
@@ -243,107 +277,112 @@ def dashboard():
     # Get user's recent orders
     recent_orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).limit(5).all()
 
-    # Get cart items count
-    cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
-
-    # Get wishlist count
-    wishlist_count = WishlistItem.query.filter_by(user_id=current_user.id).count()
-
-    # Calculate total spent
-    total_spent = db.session.query(db.func.sum(Order.total)).filter_by(user_id=current_user.id).scalar() or 0
-
-    return render_template('dashboard.html',
-                           recent_orders=recent_orders,
-                           cart_count=cart_count,
-                           wishlist_count=wishlist_count,
-                           total_spent=total_spent)
+    # Counts and lifetime spend are denormalized onto the user row
+    return render_template('dashboard.html', recent_orders=recent_orders, **counters.current(current_user.id))
 
 
 @app.route('/products')
+@read_only
 def products():
     page = request.args.get('page', 1, type=int)
     category = request.args.get('category')
     search = request.args.get('search')
-
-    query = Product.query
-
-    if category:
-        query = query.filter(Product.category == category)
+    # Price and stock facets apply to browsing; search results are filtered by category only
+    price = request.args.get('price') if not search and request.args.get('price') in PRICE_BUCKET_KEYS else None
+    in_stock = not search and request.args.get('in_stock') == '1'
+    filters = {'category': category, 'search': search, 'price': price, 'in_stock': '1' if in_stock else None}
 
     if search:
-        query = query.filter(Product.name.contains(search) | Product.description.contains(search))
-
-    products = query.paginate(page=page, per_page=12, error_out=False)
-    categories = db.session.query(Product.category).distinct().all()
+        products = search_products(search, page=page, per_page=12, category=category)
+    elif price or in_stock:
+        matches = facets.listing(category, price, in_stock, page, per_page=12)
+        products = Page(catalog_cache.products(matches.items), matches.total, matches.page, matches.per_page)
+    elif app.config['PAGINATION_MODE'] == 'keyset':
+        products = catalog_cache.keyset_listing(category, request.args.get('cursor'), per_page=12)
+    else:
+        products = catalog_cache.listing(category, page, per_page=12)
 
-    return render_template('products.html',
-                           products=products.items,
-                           pagination=products,
-                           categories=[cat[0] for cat in categories])
+    categories = catalog_cache.categories()
+    facet_counts = facets.counts(category, price, in_stock)
+    return http_cache.catalog_response(
+        lambda: render_template('products.html',
+                                products=products.items,
+                                pagination=products,
+                                categories=categories,
+                                facets=facet_counts,
+                                filters=filters),
+        products.items, page_state(products), categories, facet_counts)
 
 
 @app.route('/product/<int:product_id>')
+@read_only
 def product_detail(product_id):
-    product = Product.query.get_or_404(product_id)
-    related_products = Product.query.filter(
-        Product.category == product.category,
-        Product.id != product.id
-    ).limit(4).all()
+    product = catalog_cache.product(product_id)
+    if product is None:
+        abort(404)
+    # Frequently bought together, or the same category until there are orders to learn from
+    related_ids = recommendations.neighbors(product.id)
+    related_products = catalog_cache.products(related_ids) if related_ids else catalog_cache.related(product)
 
-    return render_template('product_detail.html',
-                           product=product,
-                           related_products=related_products)
+    return http_cache.catalog_response(
+        lambda: render_template('product_detail.html',
+                                product=product,
+                                related_products=related_products,
+                                bought_together=bool(related_ids)),
+        [product] + related_products)
 
 
 @app.route('/cart')
-@login_required
 def cart():
-    cart_items = db.session.query(CartItem).filter_by(user_id=current_user.id).all()
-    total = sum(item.quantity * item.product.price for item in cart_items)
+    cart_items = load_cart(current_user.id) if current_user.is_authenticated else guest_cart.items()
+    totals = _cart_totals(cart_items)
 
-    # Get recently viewed products (placeholder - you'd implement this with session tracking)
-    recently_viewed = Product.query.limit(3).all()
+    recommended = catalog_cache.products(recommendations.for_products([item.product_id for item in cart_items]))
 
     return render_template('cart.html',
                            cart_items=cart_items,
-                           total=total,
-                           recently_viewed=recently_viewed)
+                           totals=totals,
+                           recommended=recommended)
+
+
+def _cart_totals(cart_items):
+    """Totals for the current cart, priced from the lines the view is showing"""
+    return pricing.cart_totals(cart_items, session.get('promo_code'))
 
 
 @app.route('/add_to_cart/<int:product_id>')
-@login_required
 def add_to_cart(product_id):
-    product = Product.query.get_or_404(product_id)
+    product = catalog_cache.product(product_id)
+    if product is None:
+        abort(404)
 
     if product.stock <= 0:
         flash('Sorry, this product is out of stock.', 'warning')
         return redirect(url_for('products'))
 
-    # Check if item already in cart
-    existing_item = CartItem.query.filter_by(
-        user_id=current_user.id,
-        product_id=product_id
-    ).first()
-
-    if existing_item:
-        existing_item.quantity += 1
+    if current_user.is_authenticated:
+        increment_cart_item(current_user.id, product_id)
+        db.session.commit()
     else:
-        cart_item = CartItem(user_id=current_user.id, product_id=product_id, quantity=1)
-        db.session.add(cart_item)
-
-    db.session.commit()
+        try:
+            guest_cart.add(product_id)
+        except CartError as e:
+            flash(str(e), 'warning')
+            return redirect(url_for('products'))
     flash(f'{product.name} has been added to your cart!', 'success')
     return redirect(url_for('products'))
 
 
 @app.route('/cart/update', methods=['POST'])
-@login_required
 # @csrf.exempt  # Exempt from CSRF for AJAX requests - use with caution
 def update_cart():
     data = request.get_json()
     item_id = data.get('item_id')
     action = data.get('action')
 
+    if not current_user.is_authenticated:
+        return _update_guest_cart(item_id, action)
+
     cart_item = CartItem.query.filter_by(
         user_id=current_user.id,
         product_id=item_id
@@ -368,12 +407,14 @@ def update_cart():
 
 
 @app.route('/cart/remove', methods=['POST'])
-@login_required
 # @csrf.exempt  # Exempt from CSRF for AJAX requests - use with caution
 def remove_from_cart():
     data = request.get_json()
     item_id = data.get('item_id')
 
+    if not current_user.is_authenticated:
+        return _update_guest_cart(item_id, 'remove', 'Item removed from cart')
+
     cart_item = CartItem.query.filter_by(
         user_id=current_user.id,
         product_id=item_id
@@ -387,6 +428,48 @@ def remove_from_cart():
     return jsonify({'success': False, 'message': 'Item not found'})
 
 
+def _update_guest_cart(item_id, op, message='Cart updated successfully'):
+    if not any(str(product_id) == str(item_id) for product_id in guest_cart.quantities()):
+        return jsonify({'success': False, 'message': 'Item not found'})
+    try:
+        guest_cart.apply([{'op': op, 'item_id': item_id}])
+    except CartError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    return jsonify({'success': True, 'message': message})
+
+
+@app.route('/cart/batch', methods=['POST'])
+# @csrf.exempt  # Exempt from CSRF for AJAX requests - use with caution
+def batch_update_cart():
+    data = request.get_json(silent=True) or {}
+
+    if not current_user.is_authenticated:
+        try:
+            guest_cart.apply(data.get('operations'))
+        except CartError as e:
+            return jsonify({'success': False, 'message': str(e), 'cart': _guest_cart_state()})
+        return jsonify({'success': True, 'message': 'Cart updated successfully', 'cart': _guest_cart_state()})
+
+    try:
+        apply_cart_operations(current_user.id, data.get('operations'))
+        db.session.commit()
+    except CartError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e), 'cart': _saved_cart_state()})
+
+    return jsonify({'success': True, 'message': 'Cart updated successfully', 'cart': _saved_cart_state()})
+
+
+def _saved_cart_state():
+    items = load_cart(current_user.id)
+    return cart_state(items, _cart_totals(items))
+
+
+def _guest_cart_state():
+    items = guest_cart.items()
+    return cart_state(items, _cart_totals(items))
+
+
 @app.route('/wishlist/add', methods=['POST'])
 @login_required
 # @csrf.exempt  # Exempt from CSRF for AJAX requests - use with caution
@@ -394,95 +477,141 @@ def add_to_wishlist():
     data = request.get_json()
     item_id = data.get('item_id')
 
-    existing_item = WishlistItem.query.filter_by(
-        user_id=current_user.id,
-        product_id=item_id
-    ).first()
-
-    if existing_item:
+    if not add_wishlist_item(current_user.id, item_id):
         return jsonify({'success': False, 'message': 'Item already in wishlist'})
-
-    wishlist_item = WishlistItem(user_id=current_user.id, product_id=item_id)
-    db.session.add(wishlist_item)
     db.session.commit()
 
     return jsonify({'success': True, 'message': 'Added to wishlist!'})
 
 
 @app.route('/cart/promo', methods=['POST'])
-@login_required
 # @csrf.exempt  # Exempt from CSRF for AJAX requests - use with caution
 def apply_promo():
     data = request.get_json()
-    promo_code = data.get('promo_code', '').upper()
-
-    # Sample promo codes
-    promo_codes = {
-        'SAVE10': 0.10,
-        'WELCOME20': 0.20,
-        'NEWUSER': 0.15
-    }
-
-    if promo_code in promo_codes:
-        discount = promo_codes[promo_code]
-        session['promo_discount'] = discount
-        session['promo_code'] = promo_code
+    promo = pricing.promo(data.get('promo_code', ''))
+
+    if promo is not None:
+        session['promo_code'] = promo.code
         return jsonify({
             'success': True,
-            'message': f'Promo code applied! {int(discount * 100)}% discount'
+            'message': f'Promo code applied! {promo.describe()}'
         })
 
     return jsonify({'success': False, 'message': 'Invalid promo code'})
 
 
-@app.route('/checkout')
+@app.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+    if request.method == 'POST':
+        try:
+            order = place_order(current_user.id, pricing.promo(session.get('promo_code')))
+        except CheckoutError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('cart'))
+
+        session.pop('promo_code', None)
+        flash(f'Order #{order.id} placed successfully!', 'success')
+        return redirect(url_for('orders'))
+
+    cart_items = load_cart(current_user.id)
 
     if not cart_items:
         flash('Your cart is empty!', 'warning')
         return redirect(url_for('cart'))
 
-    subtotal = sum(item.quantity * item.product.price for item in cart_items)
-    shipping = 0 if subtotal >= 50 else 9.99
-    tax = subtotal * 0.08
-    discount = session.get('promo_discount', 0) * subtotal
-    total = subtotal + shipping + tax - discount
-
     return render_template('checkout.html',
                            cart_items=cart_items,
-                           subtotal=subtotal,
-                           shipping=shipping,
-                           tax=tax,
-                           discount=discount,
-                           total=total,
-                           promo_code=session.get('promo_code'))
+                           **_cart_totals(cart_items))
 
 
 @app.route('/orders')
 @login_required
+@read_only
 def orders():
-    page = request.args.get('page', 1, type=int)
-    orders = Order.query.filter_by(user_id=current_user.id) \
-        .order_by(Order.created_at.desc()) \
-        .paginate(page=page, per_page=10, error_out=False)
+    query = Order.query.filter_by(user_id=current_user.id) \
+        .options(selectinload(Order.order_items).joinedload(OrderItem.product))
+
+    if app.config['PAGINATION_MODE'] == 'keyset':
+        items, next_cursor, prev_cursor = keyset_paginate(
+            query, [Order.created_at, Order.id], request.args.get('cursor'), per_page=10)
+        orders = KeysetPage(items, 10, next_cursor, prev_cursor)
+    else:
+        page = request.args.get('page', 1, type=int)
+        orders = query.order_by(Order.created_at.desc()).paginate(page=page, per_page=10, error_out=False)
 
     return render_template('orders.html', orders=orders.items, pagination=orders)
 
 
+def _order_export_response(user_id, filename):
+    fmt = request.args.get('format', 'csv')
+    if fmt not in order_export.FORMATS:
+        abort(400)
+    response = Response(stream_with_context(order_export.stream(fmt, user_id)),
+                        mimetype=order_export.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}.{fmt}'
+    return response
+
+
+@app.route('/orders/export')
+@login_required
+@read_only
+def export_orders():
+    return _order_export_response(current_user.id, 'orders')
+
+
 @app.route('/search')
+@read_only
 def search():
     query = request.args.get('q', '')
-    if query:
-        products = Product.query.filter(
-            Product.name.contains(query) |
-            Product.description.contains(query)
-        ).all()
-    else:
-        products = []
+    page = request.args.get('page', 1, type=int)
+    results = search_products(query, page=page, per_page=24)
+
+    return http_cache.catalog_response(
+        lambda: render_template('search_results.html', products=results.items, pagination=results, query=query),
+        results.items, page_state(results))
+
 
-    return render_template('search_results.html', products=products, query=query)
+# Sales reports use the same days or hours the rollups are kept in
+REPORT_MAX_SPAN = {'day': timedelta(days=366), 'hour': timedelta(days=31)}
+
+
+def _require_reports_token():
+    token = app.config['REPORTS_TOKEN']
+    if not token or request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+
+
+@app.route('/reports/sales')
+@read_only
+def sales_report():
+    _require_reports_token()
+
+    granularity = request.args.get('granularity', 'day')
+    by = request.args.get('by', 'total')
+    if granularity not in sales_rollups.GRANULARITIES or by not in ('total', 'product', 'category'):
+        return jsonify({'success': False, 'message': 'granularity must be hour or day; by must be total, product or category'})
+    try:
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else datetime.utcnow()
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') \
+            else end - (timedelta(days=30) if granularity == 'day' else timedelta(hours=48))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'start and end must be ISO dates or times'})
+    if end - start > REPORT_MAX_SPAN[granularity]:
+        return jsonify({'success': False, 'message': f'{granularity} reports cover at most {REPORT_MAX_SPAN[granularity].days} days'})
+
+    return jsonify({'success': True, 'granularity': granularity, 'by': by,
+                    'start': start.isoformat(), 'end': end.isoformat(),
+                    'rows': sales_rollups.report(granularity, start, end, by)})
+
+
+@app.route('/reports/orders/export')
+@read_only
+def export_all_orders():
+    """Every user's orders, or one user's with ?user_id=, for the support team"""
+    _require_reports_token()
+    user_id = request.args.get('user_id', type=int)
+    return _order_export_response(user_id, f'orders-user-{user_id}' if user_id else 'orders-all')
 
 
 # Error handlers
@@ -502,7 +631,9 @@ def internal_error(error):
 def inject_cart_count():
     cart_count = 0
     if current_user.is_authenticated:
-        cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
+        cart_count = counters.current(current_user.id)['cart_count']
+    else:
+        cart_count = guest_cart.count()
     return dict(cart_count=cart_count)
 
 
@@ -511,8 +642,167 @@ def inject_year():
     return dict(year=datetime.now().year)
 
 
+# CLI commands
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables, columns and indexes in an existing database."""
+    schema.upgrade()
+    print('Database schema is up to date.')
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute every user's cart, wishlist, order and spend counters."""
+    repaired = counters.reconcile()
+    print(f'Repaired counters for {repaired} users.')
+
+
+@app.cli.command('backfill-sales-rollups')
+@click.option('--batch-size', default=sales_rollups.BACKFILL_BATCH_SIZE, show_default=True, help='Orders read per batch.')
+def backfill_sales_rollups_command(batch_size):
+    """Rebuild the hourly and daily sales rollups from order history."""
+    started = time.perf_counter()
+    orders = sales_rollups.backfill(batch_size)
+    print(f'Rolled up {orders} orders in {time.perf_counter() - started:.1f}s.')
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the product search index from scratch."""
+    db.create_all()
+    indexed = rebuild_index()
+    print(f'Indexed {indexed} products.')
+
+
+def _open_feed(path, mode='r'):
+    if path == '-':
+        return click.open_file(path, mode)
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def _progress_printer(verb, err=False, interval=2.0):
+    """Progress callback for catalog_io that prints at most once per ``interval`` seconds"""
+    last_printed = [0.0]
+
+    def report(stats):
+        if stats['seconds'] - last_printed[0] < interval:
+            return
+        last_printed[0] = stats['seconds']
+        rate = stats['rows'] / stats['seconds']
+        click.echo(f"{verb} {stats['rows']:,} rows ({rate:,.0f} rows/s)", err=err)
+    return report
+
+
+@app.cli.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(catalog_io.FORMATS), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=catalog_io.CHUNK_SIZE, show_default=True, help='Rows per transaction.')
+def import_catalog_command(path, fmt, chunk_size):
+    """Insert or update products from a CSV or JSON Lines feed, keyed on SKU."""
+    fmt = fmt or catalog_io.detect_format(path)
+    with _open_feed(path) as file:
+        stats = catalog_io.import_products(file, fmt, chunk_size,
+                                           progress=_progress_printer('Read'))
+    print(f"Inserted {stats['inserted']:,}, updated {stats['updated']:,}, "
+          f"skipped {stats['skipped']:,} in {stats['seconds']:.1f}s.")
+    for error in stats['errors']:
+        print(f'  {error}')
+
+
+@app.cli.command('export-catalog')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(catalog_io.FORMATS), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=catalog_io.CHUNK_SIZE, show_default=True, help='Rows fetched at a time.')
+def export_catalog_command(path, fmt, chunk_size):
+    """Write every product to a CSV or JSON Lines file ("-" for stdout)."""
+    fmt = fmt or ('jsonl' if path == '-' else catalog_io.detect_format(path))
+    with _open_feed(path, 'w') as file:
+        stats = catalog_io.export_products(file, fmt, chunk_size,
+                                           progress=_progress_printer('Wrote', err=True))
+    click.echo(f"Exported {stats['rows']:,} products in {stats['seconds']:.1f}s.", err=True)
+
+
+@app.cli.command('export-orders')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option('--user-id', type=int, help='Export one user\'s orders instead of everyone\'s.')
+@click.option('--format', 'fmt', type=click.Choice(order_export.FORMATS), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=order_export.CHUNK_SIZE, show_default=True, help='Rows fetched at a time.')
+def export_orders_command(path, user_id, fmt, chunk_size):
+    """Write order history, one row per order line, to CSV or JSON Lines ("-" for stdout)."""
+    fmt = fmt or ('jsonl' if path == '-' else catalog_io.detect_format(path))
+    with _open_feed(path, 'w') as file:
+        stats = order_export.export_orders(file, fmt, user_id, chunk_size,
+                                           progress=_progress_printer('Wrote', err=True))
+    click.echo(f"Exported {stats['rows']:,} order lines in {stats['seconds']:.1f}s.", err=True)
+
+
+@app.cli.command('generate-thumbnails')
+@click.option('--workers', default=4, show_default=True, help='Images processed in parallel.')
+def generate_thumbnails_command(workers):
+    """Fetch every product and static image and generate all thumbnail sizes."""
+    if not images.enabled:
+        raise click.ClickException('Pillow is required: pip install Pillow')
+
+    sources = [f'static:{name}' for name in sorted(os.listdir(app.static_folder))
+               if name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))]
+    sources += [url for url in db.session.execute(select(Product.image_url).distinct()).scalars()
+                if url and url.startswith(('http://', 'https://'))]
+
+    def generate(source):
+        with app.app_context():
+            try:
+                return images.generate_all(source), None
+            except ImageError as e:
+                return 0, str(e)
+
+    started = time.perf_counter()
+    written = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for count, error in pool.map(generate, sources):
+            written += count
+            if error:
+                failed += 1
+                print(f'  {error}')
+    removed = images.evict() if images.store_bytes() > images.max_bytes else 0
+    print(f'Generated {written} thumbnails for {len(sources)} images in {time.perf_counter() - started:.1f}s '
+          f'({failed} failed, {removed} evicted).')
+
+
+@app.cli.command('build-recommendations')
+@click.option('--full', is_flag=True, help='Recount every order instead of only new ones.')
+@click.option('--top-k', default=recommendations.TOP_K, show_default=True, help='Neighbors stored per product.')
+@click.option('--min-support', default=1, show_default=True, help='Orders a pair must share to be recommended.')
+def build_recommendations_command(full, top_k, min_support):
+    """Update "frequently bought together" recommendations from orders."""
+    if not recommendations.available():
+        raise click.ClickException('NumPy and SciPy are required: pip install numpy scipy')
+    stats = recommendations.refresh(app.config['RECOMMENDATIONS_STATE'], top_k, min_support, full)
+    print(f"{'Rebuilt' if stats['full'] else 'Refreshed'} recommendations through order {stats['last_order_id']}: "
+          f"{stats['neighbors']} neighbors for {stats['products']} products in {stats['seconds']:.1f}s.")
+
+
+@app.cli.command('outbox-worker')
+@click.option('--once', is_flag=True, help='Deliver everything that is due, then exit.')
+@click.option('--threads', default=1, show_default=True, help='Number of worker threads.')
+def outbox_worker_command(once, threads):
+    """Deliver queued outbox events (order confirmations, inventory sync, analytics)."""
+    if once:
+        processed = outbox.worker(app).drain()
+        print(f'Processed {processed} outbox events.')
+        return
+
+    print(f'Outbox worker running with {threads} threads; press Ctrl+C to stop.')
+    outbox.start(app, threads)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        outbox.stop()
+
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
         create_sample_data()
+        facets.rebuild()
     app.run()
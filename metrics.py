@@ -0,0 +1,225 @@
+"""Lightweight request, SQL and template instrumentation.
+
+Timings are collected from Flask request hooks, Flask template signals and
+SQLAlchemy cursor events, aggregated in process memory and exposed in the
+Prometheus text format.  Recording a request costs a handful of dict updates
+under a lock, so it is cheap enough to leave on in production.  Each worker
+process keeps its own numbers; Prometheus sums them when scraping every
+worker.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import Response, abort, before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+SLOW_STATEMENT_LIMIT = 20
+STATEMENT_TEXT_LIMIT = 200
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return ','.join(f'{key}="{_label_value(value)}"' for key, value in labels.items())
+
+
+class Metrics:
+    """Flask extension collecting per-endpoint latency and database usage"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._gauges = {}
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def reset(self):
+        with self._lock:
+            self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+            self.statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+            self.requests = defaultdict(int)
+            self.sql_seconds = defaultdict(float)
+            self.template_seconds = defaultdict(float)
+            self.template_renders = defaultdict(int)
+            self.slow_statements = {}
+            self._slow_floor = 0.0
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', False)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('SLOW_REQUEST_MS', None)
+        self.app = app
+
+        app.before_request(self._start_request)
+        app.after_request(self._capture_status)
+        app.teardown_request(self._finish_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+        event.listen(Engine, 'before_cursor_execute', self._start_statement)
+        event.listen(Engine, 'after_cursor_execute', self._finish_statement)
+
+        if app.config['METRICS_ENABLED']:
+            app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+
+        app.extensions['metrics'] = self
+
+    def register_gauge(self, name, help_text, callback):
+        """Expose the value returned by ``callback()`` as a gauge on every scrape"""
+        self._gauges[name] = (help_text, callback)
+
+    # Request hooks
+    def _start_request(self):
+        g._metrics = {'start': time.perf_counter(), 'statements': 0, 'sql_seconds': 0.0, 'status': 500}
+
+    def _capture_status(self, response):
+        state = g.get('_metrics')
+        if state is not None:
+            state['status'] = response.status_code
+        return response
+
+    def _finish_request(self, exc=None):
+        state = g.pop('_metrics', None)
+        if state is None:
+            return
+        elapsed = time.perf_counter() - state['start']
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        with self._lock:
+            self.latency[(endpoint, method)].observe(elapsed)
+            self.statements[(endpoint, method)].observe(state['statements'])
+            self.requests[(endpoint, method, state['status'])] += 1
+            self.sql_seconds[(endpoint, method)] += state['sql_seconds']
+
+        slow_ms = self.app.config['SLOW_REQUEST_MS']
+        if slow_ms is not None and elapsed * 1000 >= slow_ms:
+            self.app.logger.warning(
+                'Slow request: %s %s (%s) took %.1f ms, %d SQL statements in %.1f ms',
+                method, request.path, endpoint, elapsed * 1000,
+                state['statements'], state['sql_seconds'] * 1000)
+
+    def current_request_statements(self):
+        """Number of SQL statements issued so far by the current request"""
+        state = g.get('_metrics') if has_request_context() else None
+        return state['statements'] if state else 0
+
+    # Template signals
+    def _start_template(self, sender, template, context, **extra):
+        g.setdefault('_metrics_templates', []).append(time.perf_counter())
+
+    def _finish_template(self, sender, template, context, **extra):
+        starts = g.get('_metrics_templates')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        name = template.name or 'string'
+        with self._lock:
+            self.template_seconds[name] += elapsed
+            self.template_renders[name] += 1
+
+    # SQLAlchemy cursor events
+    def _start_statement(self, conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context, so a statement that raises leaves
+        # nothing behind on the pooled connection
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    def _finish_statement(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_metrics_start', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        if has_request_context():
+            state = g.get('_metrics')
+            if state is not None:
+                state['statements'] += 1
+                state['sql_seconds'] += elapsed
+        self._record_statement(statement, elapsed)
+
+    def _record_statement(self, statement, elapsed):
+        # Fast path: most statements are quicker than the slowest ones kept
+        if elapsed <= self._slow_floor:
+            return
+        text = ' '.join(statement.split())[:STATEMENT_TEXT_LIMIT]
+        with self._lock:
+            slow = self.slow_statements
+            if elapsed > slow.get(text, 0.0):
+                slow[text] = elapsed
+            if len(slow) > SLOW_STATEMENT_LIMIT:
+                del slow[min(slow, key=slow.get)]
+            if len(slow) >= SLOW_STATEMENT_LIMIT:
+                self._slow_floor = min(slow.values())
+
+    # Exposition
+    def _metrics_view(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            abort(403)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def render(self):
+        lines = []
+        with self._lock:
+            self._render_histograms(lines, 'shopease_request_duration_seconds',
+                                    'Request latency by endpoint', self.latency)
+            self._render_histograms(lines, 'shopease_request_sql_statements',
+                                    'SQL statements issued per request', self.statements)
+
+            lines += ['# HELP shopease_requests_total Requests by endpoint and status',
+                      '# TYPE shopease_requests_total counter']
+            for (endpoint, method, status), value in sorted(self.requests.items()):
+                lines.append(f'shopease_requests_total{{{_labels(endpoint=endpoint, method=method, status=status)}}} {value}')
+
+            lines += ['# HELP shopease_request_sql_seconds_total Time spent in SQL by endpoint',
+                      '# TYPE shopease_request_sql_seconds_total counter']
+            for (endpoint, method), value in sorted(self.sql_seconds.items()):
+                lines.append(f'shopease_request_sql_seconds_total{{{_labels(endpoint=endpoint, method=method)}}} {value:.6f}')
+
+            lines += ['# HELP shopease_template_render_seconds_total Time spent rendering templates',
+                      '# TYPE shopease_template_render_seconds_total counter']
+            for name, value in sorted(self.template_seconds.items()):
+                lines.append(f'shopease_template_render_seconds_total{{{_labels(template=name)}}} {value:.6f}')
+            lines += ['# HELP shopease_template_renders_total Template renders',
+                      '# TYPE shopease_template_renders_total counter']
+            for name, value in sorted(self.template_renders.items()):
+                lines.append(f'shopease_template_renders_total{{{_labels(template=name)}}} {value}')
+
+            lines += ['# HELP shopease_slow_statement_seconds Slowest SQL statements seen by this process',
+                      '# TYPE shopease_slow_statement_seconds gauge']
+            for text, value in sorted(self.slow_statements.items(), key=lambda item: -item[1]):
+                lines.append(f'shopease_slow_statement_seconds{{{_labels(statement=text)}}} {value:.6f}')
+
+        for name, (help_text, callback) in sorted(self._gauges.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {callback()}']
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histograms(lines, name, help_text, histograms):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for (endpoint, method), histogram in sorted(histograms.items()):
+            labels = _labels(endpoint=endpoint, method=method)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
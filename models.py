@@ -0,0 +1,164 @@
+from flask_sqlalchemy import SQLAlchemy
+from flask_login import UserMixin
+from datetime import datetime
+
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+# Database Models
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(100), nullable=False, unique=True)
+    email = db.Column(db.String(150), unique=True, nullable=False)
+    password = db.Column(db.String(200), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Denormalized counters, maintained by counters.py
+    cart_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    wishlist_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    order_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_spent = db.Column(db.Float, nullable=False, default=0, server_default='0')
+
+    # Relationships
+    orders = db.relationship('Order', backref='user', lazy=True)
+    cart_items = db.relationship('CartItem', backref='user', lazy=True)
+    wishlist_items = db.relationship('WishlistItem', backref='user', lazy=True)
+
+
+class Product(db.Model):
+    __table_args__ = (
+        db.Index('ix_product_created_id', 'created_at', 'id'),
+        db.Index('ix_product_category_created_id', 'category', 'created_at', 'id'),
+        db.Index('uq_product_sku', 'sku', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    sku = db.Column(db.String(64))
+    name = db.Column(db.String(200), nullable=False)
+    description = db.Column(db.Text, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    image_url = db.Column(db.String(500))
+    stock = db.Column(db.Integer, default=0)
+    category = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped by every UPDATE, including bulk ones; drives HTTP validators (see http_cache.py)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Relationships
+    cart_items = db.relationship('CartItem', backref='product', lazy=True)
+    order_items = db.relationship('OrderItem', backref='product', lazy=True)
+    wishlist_items = db.relationship('WishlistItem', backref='product', lazy=True)
+
+
+class CartItem(db.Model):
+    __table_args__ = (
+        db.Index('uq_cart_item_user_product', 'user_id', 'product_id', unique=True),
+        db.Index('ix_cart_item_product_id', 'product_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Order(db.Model):
+    __table_args__ = (
+        db.Index('ix_order_user_created', 'user_id', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(50), default='pending')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Relationships
+    order_items = db.relationship('OrderItem', backref='order', lazy=True)
+
+
+class OrderItem(db.Model):
+    __table_args__ = (
+        db.Index('ix_order_item_order_id', 'order_id'),
+        db.Index('ix_order_item_product_id', 'product_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+
+
+class WishlistItem(db.Model):
+    __table_args__ = (
+        db.Index('uq_wishlist_item_user_product', 'user_id', 'product_id', unique=True),
+        db.Index('ix_wishlist_item_product_id', 'product_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SearchTerm(db.Model):
+    """One row of the product search inverted index (see search.py)"""
+    term = db.Column(db.String(64), primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True, index=True)
+    weight = db.Column(db.Float, nullable=False)
+
+
+class ProductNeighbor(db.Model):
+    """One precomputed "frequently bought together" neighbor of a product (see recommendations.py)"""
+    product_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    neighbor_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+
+class SalesRollup(db.Model):
+    """Orders, units and revenue for one product in one hour or day (see sales_rollups.py)"""
+    __table_args__ = (
+        db.Index('ix_sales_rollup_category', 'granularity', 'category', 'period_start'),
+    )
+
+    granularity = db.Column(db.String(8), primary_key=True)
+    period_start = db.Column(db.DateTime, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    category = db.Column(db.String(100))
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+
+class PromoCode(db.Model):
+    """A promo code: ``percent`` off the subtotal, or a fixed ``amount`` in cents (see pricing.py)"""
+    code = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(10), nullable=False, default='percent')
+    value = db.Column(db.Integer, nullable=False)
+    min_subtotal_cents = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    active = db.Column(db.Boolean, nullable=False, default=True, server_default='1')
+    expires_at = db.Column(db.DateTime)
+
+
+class OutboxEvent(db.Model):
+    """A side effect to run after commit, written in the same transaction as its cause (see outbox.py)"""
+    __table_args__ = (
+        db.Index('ix_outbox_event_status_available', 'status', 'available_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(64))
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
@@ -0,0 +1,89 @@
+"""Streaming export of order history.
+
+Every order line becomes one CSV or JSON Lines row, with its order's id,
+owner, date, status and total repeated alongside.  Orders without lines
+still get one row.  Rows come from a single
+``Order ⟕ OrderItem ⟕ Product`` query executed with ``yield_per``, so the
+driver fetches them from a server-side cursor ``CHUNK_SIZE`` at a time.
+Each chunk is formatted and handed on before the next one is read, and
+memory stays flat whether a customer has ten orders or the export covers
+every user.  ``stream()`` feeds an HTTP response; ``export_orders()``
+writes to a file for the CLI.
+"""
+import csv
+import io
+import json
+import time
+
+from sqlalchemy import select
+
+from models import db, Order, OrderItem, Product
+
+CHUNK_SIZE = 1000
+FORMATS = ('csv', 'jsonl')
+MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+FIELDS = ('order_id', 'user_id', 'created_at', 'status', 'order_total',
+          'product_id', 'sku', 'product_name', 'quantity', 'price')
+
+
+def _query(user_id=None):
+    query = (select(Order.id.label('order_id'), Order.user_id, Order.created_at, Order.status,
+                    Order.total.label('order_total'), OrderItem.product_id, Product.sku,
+                    Product.name.label('product_name'), OrderItem.quantity, OrderItem.price)
+             .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+             .outerjoin(Product, Product.id == OrderItem.product_id)
+             .order_by(Order.id, OrderItem.id))
+    if user_id is not None:
+        query = query.where(Order.user_id == user_id)
+    return query
+
+
+def _partitions(user_id=None, chunk_size=CHUNK_SIZE):
+    result = db.session.execute(_query(user_id).execution_options(yield_per=chunk_size))
+    for partition in result.mappings().partitions():
+        yield [{**row, 'created_at': row['created_at'].isoformat() if row['created_at'] else None}
+               for row in partition]
+
+
+def _format_csv(partitions):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+    writer.writeheader()
+    for rows in partitions:
+        writer.writerows(rows)
+        yield buffer.getvalue(), len(rows)
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue(), 0
+
+
+def _format_jsonl(partitions):
+    for rows in partitions:
+        yield ''.join(json.dumps(row) + '\n' for row in rows), len(rows)
+
+
+def _chunks(fmt, user_id=None, chunk_size=CHUNK_SIZE):
+    """Yield ``(text, rows)`` pairs, one per fetched chunk"""
+    partitions = _partitions(user_id, chunk_size)
+    return _format_csv(partitions) if fmt == 'csv' else _format_jsonl(partitions)
+
+
+def stream(fmt, user_id=None, chunk_size=CHUNK_SIZE):
+    """Yield the export as text chunks; ``user_id=None`` exports every user's orders"""
+    for text, _ in _chunks(fmt, user_id, chunk_size):
+        yield text
+
+
+def export_orders(file, fmt, user_id=None, chunk_size=CHUNK_SIZE, progress=None):
+    """Write the export to ``file``; returns the stats dict"""
+    stats = {'rows': 0, 'seconds': 0.0}
+    started = time.perf_counter()
+    for text, rows in _chunks(fmt, user_id, chunk_size):
+        file.write(text)
+        stats['rows'] += rows
+        stats['seconds'] = time.perf_counter() - started
+        if progress is not None:
+            progress(stats)
+    return stats
@@ -0,0 +1,302 @@
+"""Transactional outbox for work that follows an order.
+
+``enqueue()`` adds an ``OutboxEvent`` row to the current session, so the
+event commits or rolls back together with the order that caused it.  The
+request never waits for confirmation e-mails, inventory sync or analytics.
+
+``OutboxWorker`` drains the table outside the request.  It claims a batch of
+due events with a conditional UPDATE, so two workers never run the same
+event at once.  It then runs every handler registered for each event's topic
+and marks the successful ones done in a single statement.  A failing event
+is retried with exponential backoff until ``OUTBOX_MAX_ATTEMPTS``, then
+parked as ``failed``.
+
+Delivery is at least once: claims left behind by a worker that died expire
+after ``OUTBOX_CLAIM_TIMEOUT`` seconds and are picked up again.  Handlers
+receive ``event.key``, a stable idempotency key, and must not repeat their
+effect when they see a key twice.
+"""
+import json
+import logging
+import random
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from flask import current_app
+from sqlalchemy import and_, func, or_, select, update
+
+from models import db, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+_handlers = defaultdict(list)
+
+
+def handler(topic):
+    """Register the decorated function to run for every event on ``topic``"""
+    def register(func):
+        _handlers[topic].append(func)
+        return func
+    return register
+
+
+def handlers_for(topic):
+    return list(_handlers.get(topic, ()))
+
+
+def enqueue(topic, payload, session=None):
+    """Add an event to the caller's transaction; it is only delivered if that transaction commits"""
+    event = OutboxEvent(topic=topic, payload=json.dumps(payload, default=str))
+    (session or db.session).add(event)
+    return event
+
+
+class LogSink:
+    """Writes deliveries to the application log"""
+
+    def send(self, key, kind, data):
+        logger.info('outbox delivery %s %s: %s', kind, key, data)
+        return True
+
+
+class MemorySink:
+    """Keeps deliveries in memory, once per key; a local stand-in for the real services"""
+
+    def __init__(self):
+        self.deliveries = {}
+        self._lock = threading.Lock()
+
+    def send(self, key, kind, data):
+        """Record a delivery; returns False if ``key`` was already delivered"""
+        with self._lock:
+            if key in self.deliveries:
+                return False
+            self.deliveries[key] = (kind, data)
+            return True
+
+    def sent(self, kind=None):
+        with self._lock:
+            return [data for sent_kind, data in self.deliveries.values() if kind in (None, sent_kind)]
+
+    def clear(self):
+        with self._lock:
+            self.deliveries.clear()
+
+
+def sink():
+    return current_app.extensions['outbox'].sink
+
+
+@handler('order.placed')
+def send_order_confirmation(event):
+    sink().send(f'{event.key}:confirmation', 'order_confirmation', event.payload)
+
+
+@handler('order.placed')
+def sync_inventory(event):
+    sink().send(f'{event.key}:inventory', 'inventory', {'order_id': event.payload['order_id'],
+                                                        'items': event.payload['items']})
+
+
+@handler('order.placed')
+def record_order_analytics(event):
+    sink().send(f'{event.key}:analytics', 'analytics', event.payload)
+
+
+class OutboxWorker:
+    """Claims due outbox events in batches and runs their handlers"""
+
+    def __init__(self, app, batch_size=50, max_attempts=8, retry_delay=2, max_retry_delay=600,
+                 claim_timeout=300):
+        self.app = app
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.claim_timeout = claim_timeout
+
+    def _due(self, now):
+        expired = now - timedelta(seconds=self.claim_timeout)
+        return or_(
+            and_(OutboxEvent.status == 'pending', OutboxEvent.available_at <= now),
+            and_(OutboxEvent.status == 'processing', OutboxEvent.claimed_at < expired),
+        )
+
+    def _claim(self, token):
+        now = datetime.utcnow()
+        ids = db.session.execute(
+            select(OutboxEvent.id).where(self._due(now)).order_by(OutboxEvent.id).limit(self.batch_size)
+        ).scalars().all()
+        if not ids:
+            db.session.rollback()
+            return []
+        # Re-checking the due condition makes the claim atomic: a worker that
+        # lost the race for an id updates nothing for it
+        db.session.execute(
+            update(OutboxEvent)
+            .where(OutboxEvent.id.in_(ids), self._due(now))
+            .values(status='processing', claimed_by=token, claimed_at=now, attempts=OutboxEvent.attempts + 1)
+            .execution_options(synchronize_session=False)
+        )
+        rows = db.session.execute(
+            select(OutboxEvent.id, OutboxEvent.topic, OutboxEvent.payload, OutboxEvent.attempts)
+            .where(OutboxEvent.claimed_by == token)
+            .order_by(OutboxEvent.id)
+        ).all()
+        db.session.commit()
+        return [SimpleNamespace(id=row.id, key=f'outbox-{row.id}', topic=row.topic,
+                                payload=json.loads(row.payload), attempts=row.attempts) for row in rows]
+
+    def _backoff(self, attempts):
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+        return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+    def run_once(self):
+        """Claim and process one batch; returns the number of events claimed"""
+        token = uuid.uuid4().hex
+        with self.app.app_context():
+            events = self._claim(token)
+            done, failed = [], []
+            for event in events:
+                try:
+                    handlers = handlers_for(event.topic)
+                    if not handlers:
+                        raise LookupError(f'No outbox handler registered for {event.topic!r}')
+                    for handler in handlers:
+                        handler(event)
+                    done.append(event.id)
+                except Exception as e:
+                    logger.exception('Outbox event %s (%s) failed on attempt %s', event.id, event.topic, event.attempts)
+                    failed.append((event, e))
+
+            now = datetime.utcnow()
+            claimed = OutboxEvent.claimed_by == token
+            if done:
+                db.session.execute(
+                    update(OutboxEvent)
+                    .where(OutboxEvent.id.in_(done), claimed)
+                    .values(status='done', processed_at=now, claimed_by=None, last_error=None)
+                    .execution_options(synchronize_session=False)
+                )
+            for event, error in failed:
+                give_up = event.attempts >= self.max_attempts
+                db.session.execute(
+                    update(OutboxEvent)
+                    .where(OutboxEvent.id == event.id, claimed)
+                    .values(status='failed' if give_up else 'pending',
+                            available_at=now + self._backoff(event.attempts),
+                            claimed_by=None, last_error=repr(error)[:2000])
+                    .execution_options(synchronize_session=False)
+                )
+            db.session.commit()
+        return len(events)
+
+    def drain(self):
+        """Process batches until nothing is due; returns the number of events claimed"""
+        total = 0
+        while True:
+            claimed = self.run_once()
+            total += claimed
+            if not claimed:
+                return total
+
+    def run_forever(self, stop, poll_interval=1.0):
+        """Keep draining until ``stop`` (a threading.Event) is set"""
+        errors = 0
+        while not stop.is_set():
+            try:
+                claimed = self.run_once()
+            except Exception:
+                # A lost database, a missing table or a bug must not end the thread
+                errors += 1
+                logger.exception('Outbox worker batch failed (%s in a row)', errors)
+                stop.wait(min(poll_interval * 2 ** errors, self.max_retry_delay))
+                continue
+            errors = 0
+            if claimed < self.batch_size:
+                stop.wait(poll_interval)
+
+
+class Outbox:
+    """Flask extension holding the outbox configuration, sink and worker threads"""
+
+    def __init__(self, app=None):
+        self.sink = LogSink()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._serving = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('OUTBOX_SINK', 'log')
+        app.config.setdefault('OUTBOX_BATCH_SIZE', 50)
+        app.config.setdefault('OUTBOX_MAX_ATTEMPTS', 8)
+        app.config.setdefault('OUTBOX_RETRY_DELAY', 2)
+        app.config.setdefault('OUTBOX_MAX_RETRY_DELAY', 600)
+        app.config.setdefault('OUTBOX_CLAIM_TIMEOUT', 300)
+        app.config.setdefault('OUTBOX_POLL_INTERVAL', 1.0)
+        app.config.setdefault('OUTBOX_WORKER_THREADS', 0)
+
+        sink_name = app.config['OUTBOX_SINK']
+        if sink_name == 'log':
+            self.sink = LogSink()
+        elif sink_name == 'memory':
+            self.sink = MemorySink()
+        else:
+            raise ValueError(f'Unknown OUTBOX_SINK: {sink_name}')
+
+        app.extensions['outbox'] = self
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.register_gauge('shopease_outbox_pending', 'Outbox events waiting to be delivered',
+                                   self.pending_count)
+
+        if app.config['OUTBOX_WORKER_THREADS']:
+            # Started by the first request, so CLI commands that import the app
+            # (upgrade-db, import-catalog, ...) never run workers
+            app.before_request(self._start_serving_workers)
+
+    def _start_serving_workers(self):
+        if self._serving:
+            return
+        with self._lock:
+            if not self._serving:
+                app = current_app._get_current_object()
+                self.start(app, app.config['OUTBOX_WORKER_THREADS'])
+                self._serving = True
+
+    def worker(self, app):
+        return OutboxWorker(
+            app,
+            batch_size=app.config['OUTBOX_BATCH_SIZE'],
+            max_attempts=app.config['OUTBOX_MAX_ATTEMPTS'],
+            retry_delay=app.config['OUTBOX_RETRY_DELAY'],
+            max_retry_delay=app.config['OUTBOX_MAX_RETRY_DELAY'],
+            claim_timeout=app.config['OUTBOX_CLAIM_TIMEOUT'],
+        )
+
+    def start(self, app, threads=1):
+        """Start ``threads`` background workers in this process"""
+        self._stop.clear()
+        for i in range(threads):
+            thread = threading.Thread(target=self.worker(app).run_forever,
+                                      args=(self._stop, app.config['OUTBOX_POLL_INTERVAL']),
+                                      name=f'outbox-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def pending_count(self):
+        return db.session.execute(
+            select(func.count()).select_from(OutboxEvent).where(OutboxEvent.status.in_(('pending', 'processing')))
+        ).scalar()
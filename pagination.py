@@ -0,0 +1,137 @@
+"""Pagination helpers shared by the catalog views."""
+from datetime import datetime
+from math import ceil
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import and_, or_
+
+
+class Page:
+    """A page of already-loaded items, shaped like Flask-SQLAlchemy's Pagination"""
+
+    def __init__(self, items, total, page, per_page):
+        self.items = items
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+
+    @property
+    def pages(self):
+        return ceil(self.total / self.per_page) if self.total else 0
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=4, right_edge=2):
+        last = 0
+        for num in range(1, self.pages + 1):
+            if (num <= left_edge
+                    or self.page - left_current - 1 < num < self.page + right_current
+                    or num > self.pages - right_edge):
+                if last + 1 != num:
+                    yield None
+                yield num
+                last = num
+
+
+class KeysetPage:
+    """A page fetched by keyset (cursor) pagination.
+
+    Only next/previous links are available; ``total`` is filled in only when a
+    caller asked for (or already had) a count.
+    """
+    keyset = True
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def _cursor_serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='keyset-cursor')
+
+
+def encode_cursor(direction, values):
+    """Return an opaque, signed token for a position in a keyset ordering"""
+    encoded = [{'dt': value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return _cursor_serializer().dumps([direction, encoded])
+
+
+def decode_cursor(token):
+    """Return (direction, values) for a token, or (None, None) if it is missing or invalid"""
+    if not token:
+        return None, None
+    try:
+        direction, encoded = _cursor_serializer().loads(token)
+    except (BadSignature, ValueError, TypeError):
+        return None, None
+    if direction not in ('next', 'prev'):
+        return None, None
+    values = [datetime.fromisoformat(value['dt']) if isinstance(value, dict) else value for value in encoded]
+    return direction, values
+
+
+def _beyond(columns, values, descending):
+    """Rows strictly after ``values`` in (columns...) order, expanded for index use"""
+    clauses = []
+    for i, column in enumerate(columns):
+        condition = column < values[i] if descending else column > values[i]
+        equal_prefix = [columns[j] == values[j] for j in range(i)]
+        clauses.append(and_(*equal_prefix, condition))
+    return or_(*clauses)
+
+
+def keyset_paginate(query, columns, cursor=None, per_page=12):
+    """Fetch one page of ``query`` ordered newest first by ``columns``.
+
+    ``columns`` must form a unique sort key (e.g. ``created_at, id``).  Every
+    page costs one indexed range scan of ``per_page + 1`` rows, however deep
+    the page is.
+    """
+    direction, values = decode_cursor(cursor)
+    if values is not None and len(values) != len(columns):
+        direction, values = None, None
+    forward = direction != 'prev'
+
+    if values is not None:
+        query = query.filter(_beyond(columns, values, descending=forward))
+    order = [column.desc() if forward else column.asc() for column in columns]
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+
+    def key(row):
+        return [getattr(row, column.key) for column in columns]
+
+    has_next = has_more if forward else True
+    has_prev = values is not None if forward else has_more
+    next_cursor = encode_cursor('next', key(rows[-1])) if rows and has_next else None
+    prev_cursor = encode_cursor('prev', key(rows[0])) if rows and has_prev else None
+    return rows, next_cursor, prev_cursor
@@ -0,0 +1,156 @@
+"""Password hashing on a bounded process pool.
+
+Hashing is deliberately slow and CPU-bound.  Running it on the request thread
+lets a burst of sign-ups or logins starve every other route.  ``PasswordHasher``
+runs hashes on a small process pool of its own.  It admits at most
+``PASSWORD_HASH_MAX_PENDING`` hashes at a time and waits at most
+``PASSWORD_HASH_TIMEOUT`` seconds for each.  Callers that are turned away get
+``PasswordHasherBusy`` quickly instead of queueing without limit.
+
+``PASSWORD_HASH_METHOD`` accepts any werkzeug method string, e.g.
+``scrypt:32768:8:1`` or ``pbkdf2:sha256:600000``.  ``verify()`` reports a
+fresh hash when a correct password was stored with other parameters, so
+raising the cost upgrades users as they log in.  Set
+``PASSWORD_HASH_WORKERS=0`` to hash inline.
+
+Each WSGI worker process creates its own pool on first use.  The pool's
+processes are started with ``forkserver`` (``spawn`` where that is not
+available), never forked from the threaded server, so they cannot inherit
+a lock another thread was holding.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    """The hashing pool is saturated or too slow; the caller should ask the user to retry"""
+
+
+@lru_cache(maxsize=None)
+def _method_prefix(method):
+    # werkzeug stores the fully expanded method ("scrypt" -> "scrypt:32768:8:1")
+    # in front of the first "$"; hash once to learn it
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def needs_rehash(pwhash, method):
+    return pwhash.split('$', 1)[0] != _method_prefix(method)
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(pwhash, password, method):
+    """Return (matches, new_hash), where new_hash is set if the stored parameters are outdated"""
+    if not check_password_hash(pwhash, password):
+        return False, None
+    return True, (_hash(password, method) if needs_rehash(pwhash, method) else None)
+
+
+def _pool_context():
+    # Forking a process that runs threads can copy a held lock into the child
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+
+class PasswordHasher:
+    """Flask extension that hashes and verifies passwords off the request thread"""
+
+    def __init__(self, app=None):
+        self.method = 'scrypt'
+        self.workers = 2
+        self.max_pending = 8
+        self.timeout = 10.0
+        self.pending = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._pool = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt')
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_MAX_PENDING', app.config['PASSWORD_HASH_WORKERS'] * 4)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10.0)
+
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.max_pending = app.config['PASSWORD_HASH_MAX_PENDING']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+
+        app.extensions['password_hasher'] = self
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.register_gauge('shopease_password_hash_queue_depth',
+                                   'Password hashes queued or running', lambda: self.pending)
+            metrics.register_gauge('shopease_password_hash_rejected',
+                                   'Password hashes refused because the pool was full', lambda: self.rejected)
+            metrics.register_gauge('shopease_password_hash_timeouts',
+                                   'Password hashes abandoned after PASSWORD_HASH_TIMEOUT', lambda: self.timeouts)
+
+    def _get_pool(self):
+        # Created on first use, so every forked WSGI worker gets its own pool
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+        return self._pool
+
+    def _submit(self, func, *args):
+        try:
+            return self._get_pool().submit(func, *args)
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool once
+            self._pool = None
+            return self._get_pool().submit(func, *args)
+
+    def _release(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordHasherBusy('Too many password hashes in progress')
+            self.pending += 1
+            try:
+                future = self._submit(func, *args)
+            except BaseException:
+                self.pending -= 1
+                raise
+        future.add_done_callback(self._release)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            raise PasswordHasherBusy('Password hashing timed out')
+        except BrokenProcessPool:
+            with self._lock:
+                self._pool = None
+            raise PasswordHasherBusy('Password hashing pool crashed')
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        """Check a password; returns (matches, new_hash_or_None)"""
+        return self._run(_verify, pwhash, password, self.method)
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
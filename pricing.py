@@ -0,0 +1,175 @@
+"""Cart totals in integer cents.
+
+Prices are stored as floats, so adding them up in Python drifts by a cent
+here and there.  Totals are computed in whole cents instead: every price is
+converted once with ``to_cents()``, the same function checkout uses to charge
+the order, and shipping, tax and discounts are integer arithmetic on the
+subtotal, rounded half up.  As before, shipping and tax are charged on the
+subtotal before any discount.
+
+Totals are priced from the cart lines the view has already loaded (see
+``cart_service.load_cart()``), so they always match the lines shown next to
+them and cost no query of their own.  There is deliberately no SQL aggregate
+and no memo of totals: the page needs the lines anyway, so an aggregate would
+be an extra query, and summing a few lines in Python costs less than keeping
+a cart version stamp in sync across every cart write.
+
+Promo codes live in the ``PromoCode`` table.  They are compiled into
+``PromoRule`` tuples on first use and reloaded when a change to the table is
+committed in this process, or every ``PROMO_RULES_TTL`` seconds otherwise.
+"""
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.orm import Session
+
+from models import PromoCode
+from replicas import primary_reads
+
+FREE_SHIPPING_THRESHOLD_CENTS = 5000
+SHIPPING_FEE_CENTS = 999
+TAX_RATE_BASIS_POINTS = 800
+PROMO_RULES_CHANGED_KEY = 'pricing_promo_rules_changed'
+
+# The codes that used to be hard-coded in the promo view; seeded into new databases
+DEFAULT_PROMO_CODES = (
+    {'code': 'SAVE10', 'kind': 'percent', 'value': 10},
+    {'code': 'WELCOME20', 'kind': 'percent', 'value': 20},
+    {'code': 'NEWUSER', 'kind': 'percent', 'value': 15},
+)
+
+
+def to_cents(amount):
+    """Whole cents for a float price, rounded half up"""
+    return int((Decimal(repr(float(amount or 0))) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _share(cents, basis_points):
+    """``basis_points`` / 10000 of ``cents``, rounded half up"""
+    return (cents * basis_points + 5000) // 10000
+
+
+class PromoRule(namedtuple('PromoRule', 'code kind value min_subtotal_cents expires_at')):
+    """A compiled promo code"""
+
+    @classmethod
+    def from_model(cls, promo):
+        return cls(promo.code.upper(), promo.kind, promo.value, promo.min_subtotal_cents or 0, promo.expires_at)
+
+    def expired(self, now=None):
+        return self.expires_at is not None and self.expires_at <= (now or datetime.utcnow())
+
+    def discount_cents(self, subtotal_cents):
+        if subtotal_cents < self.min_subtotal_cents:
+            return 0
+        if self.kind == 'percent':
+            return _share(subtotal_cents, self.value * 100)
+        return min(self.value, subtotal_cents)
+
+    def describe(self):
+        off = f'{self.value}%' if self.kind == 'percent' else f'${self.value / 100:.2f}'
+        if self.min_subtotal_cents:
+            return f'{off} off orders of ${self.min_subtotal_cents / 100:.2f} or more'
+        return f'{off} discount'
+
+
+def price_subtotal(subtotal_cents, rule=None):
+    """Shipping, tax, discount and total for a subtotal in cents.
+
+    Amounts are returned in dollars for templates and JSON, computed from
+    exact cents; ``total_cents`` is the amount to charge.
+    """
+    shipping = 0 if subtotal_cents >= FREE_SHIPPING_THRESHOLD_CENTS else SHIPPING_FEE_CENTS
+    tax = _share(subtotal_cents, TAX_RATE_BASIS_POINTS)
+    discount = rule.discount_cents(subtotal_cents) if rule is not None else 0
+    total = subtotal_cents + shipping + tax - discount
+    return {
+        'subtotal': subtotal_cents / 100,
+        'shipping': shipping / 100,
+        'tax': tax / 100,
+        'discount': discount / 100,
+        'total': total / 100,
+        'total_cents': total,
+        'promo_code': rule.code if discount else None,
+        'free_shipping_remaining': max(FREE_SHIPPING_THRESHOLD_CENTS - subtotal_cents, 0) / 100,
+    }
+
+
+class Pricing:
+    """Flask extension caching compiled promo rules and pricing carts"""
+
+    def __init__(self, app=None):
+        self.rules_ttl = 60
+        self._rules = None
+        self._rules_loaded_at = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROMO_RULES_TTL', 60)
+        self.rules_ttl = app.config['PROMO_RULES_TTL']
+        app.extensions['pricing'] = self
+
+    # Promo rules
+    def invalidate_rules(self):
+        with self._lock:
+            self._rules_loaded_at = None
+
+    def rules(self):
+        """``{code: PromoRule}`` for every active code, compiled once and cached"""
+        with self._lock:
+            if self._rules_loaded_at is not None and time.monotonic() - self._rules_loaded_at <= self.rules_ttl:
+                return self._rules
+        with primary_reads():
+            rules = {rule.code: rule for rule in map(PromoRule.from_model,
+                                                      PromoCode.query.filter(PromoCode.active.is_(True)))}
+        with self._lock:
+            self._rules = rules
+            self._rules_loaded_at = time.monotonic()
+            return self._rules
+
+    def promo(self, code):
+        """The rule for a promo code if it is active and unexpired, else None"""
+        if not code:
+            return None
+        rule = self.rules().get(code.strip().upper())
+        return None if rule is None or rule.expired() else rule
+
+    # Totals
+    def cart_totals(self, lines, promo_code=None):
+        """Totals for cart lines with their products loaded, saved or guest"""
+        subtotal_cents = sum(line.quantity * to_cents(line.product.price) for line in lines)
+        return price_subtotal(subtotal_cents, self.promo(promo_code))
+
+
+def seed_promo_codes(executor):
+    """Insert ``DEFAULT_PROMO_CODES`` if there are no promo codes yet; returns the number added"""
+    if executor.execute(select(func.count()).select_from(PromoCode)).scalar():
+        return 0
+    executor.execute(insert(PromoCode), [{'active': True, 'min_subtotal_cents': 0, **promo}
+                                         for promo in DEFAULT_PROMO_CODES])
+    return len(DEFAULT_PROMO_CODES)
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_promo_changes(session, flush_context):
+    if any(isinstance(obj, PromoCode) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info[PROMO_RULES_CHANGED_KEY] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _reload_promo_rules(session):
+    if session.info.pop(PROMO_RULES_CHANGED_KEY, False):
+        if has_app_context() and 'pricing' in current_app.extensions:
+            current_app.extensions['pricing'].invalidate_rules()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_promo_changes(session):
+    session.info.pop(PROMO_RULES_CHANGED_KEY, None)
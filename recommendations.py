@@ -0,0 +1,202 @@
+"""Precomputed "frequently bought together" recommendations.
+
+``flask --app main build-recommendations`` counts how often each pair of
+products was bought in the same order.  The counts are a sparse matrix
+``C = AᵀA`` over the order/product incidence matrix ``A``, and its diagonal
+holds the number of orders containing each product.  Pairs are scored with
+cosine similarity, ``C[i, j] / sqrt(C[i, i] * C[j, j])``, and the best
+``TOP_K`` neighbors of every product are stored in ``ProductNeighbor``.
+Pages read them back with a single primary-key lookup.
+
+The matrix is saved to ``RECOMMENDATIONS_STATE`` together with the ids of
+the orders counted in the last ``RESCAN_WINDOW`` order ids.  The next run
+scans from the start of that window, skips the orders already counted, and
+rescores only the products whose scores could have changed.  An order whose
+transaction committed after a higher order id had been counted is therefore
+still picked up.  NumPy and SciPy are needed to build recommendations, not
+to serve them.
+"""
+import os
+import time
+
+from sqlalchemy import delete, func, insert, select
+
+from models import db, OrderItem, ProductNeighbor
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # NumPy/SciPy are only needed by the build job
+    np = sparse = None
+
+TOP_K = 10
+ORDER_CHUNK = 50000
+RESCAN_WINDOW = 10000
+WRITE_CHUNK = 500
+
+
+# Serving
+def neighbors(product_id, limit=4):
+    """Ids of a product's best co-purchased products, best first"""
+    return db.session.execute(
+        select(ProductNeighbor.neighbor_id)
+        .where(ProductNeighbor.product_id == product_id)
+        .order_by(ProductNeighbor.rank)
+        .limit(limit)
+    ).scalars().all()
+
+
+def for_products(product_ids, limit=3):
+    """Ids most often bought with any of ``product_ids``, excluding those products"""
+    product_ids = set(product_ids)
+    if not product_ids:
+        return []
+    rows = db.session.execute(
+        select(ProductNeighbor.neighbor_id, ProductNeighbor.score)
+        .where(ProductNeighbor.product_id.in_(product_ids))
+    ).all()
+    best = {}
+    for neighbor_id, score in rows:
+        if neighbor_id not in product_ids and score > best.get(neighbor_id, 0):
+            best[neighbor_id] = score
+    return sorted(best, key=lambda neighbor_id: (-best[neighbor_id], neighbor_id))[:limit]
+
+
+# Building
+def available():
+    return np is not None
+
+
+def _empty_ids():
+    return np.zeros(0, dtype=np.int64)
+
+
+def load_state(path):
+    """Return (co-purchase matrix, order id to scan after, ids counted above it).
+
+    Without a usable saved state this is ``(None, 0, [])``, and the next
+    refresh rebuilds from every order.
+    """
+    if not os.path.exists(path):
+        return None, 0, _empty_ids()
+    with np.load(path) as state:
+        if 'counted' not in state:
+            return None, 0, _empty_ids()
+        matrix = sparse.csr_matrix((state['data'], state['indices'], state['indptr']), shape=tuple(state['shape']))
+        return matrix, int(state['scan_after']), state['counted'].astype(np.int64)
+
+
+def save_state(path, matrix, scan_after, counted):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp.npz'
+    np.savez_compressed(tmp_path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                        shape=np.array(matrix.shape), scan_after=np.array(scan_after), counted=counted)
+    os.replace(tmp_path, path)
+
+
+def _grow(matrix, size):
+    if matrix is None:
+        return sparse.csr_matrix((size, size), dtype=np.int64)
+    if matrix.shape[0] < size:
+        matrix = matrix.tocoo()
+        matrix = sparse.csr_matrix((matrix.data, (matrix.row, matrix.col)), shape=(size, size))
+    return matrix
+
+
+def _co_purchases(scan_after, counted, size):
+    """Co-purchase counts of orders after ``scan_after`` that are not in ``counted``.
+
+    Returns (matrix, ids of the orders counted).  The matrix grows to fit
+    every product id the scan reads.
+    """
+    last_order_id = db.session.execute(select(func.max(OrderItem.order_id))).scalar() or 0
+    counts = _grow(None, size)
+    new_ids = []
+    for low in range(scan_after, last_order_id, ORDER_CHUNK):
+        rows = db.session.execute(
+            select(OrderItem.order_id, OrderItem.product_id)
+            .where(OrderItem.order_id > low, OrderItem.order_id <= min(low + ORDER_CHUNK, last_order_id))
+        ).all()
+        pairs = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        pairs = pairs[~np.isin(pairs[:, 0], counted)]
+        if not len(pairs):
+            continue
+        new_ids.append(np.unique(pairs[:, 0]))
+        size = max(size, int(pairs[:, 1].max()) + 1)
+        counts = _grow(counts, size)
+        incidence = sparse.csr_matrix(
+            (np.ones(len(pairs), dtype=np.int64), (pairs[:, 0] - low - 1, pairs[:, 1])),
+            shape=(ORDER_CHUNK, size))
+        # Two lines for the same product in one order still count as one purchase
+        incidence.sum_duplicates()
+        incidence.data[:] = 1
+        counts = counts + (incidence.T @ incidence)
+    return counts.tocsr(), np.concatenate(new_ids) if new_ids else _empty_ids()
+
+
+def _top_neighbors(matrix, product_ids, top_k, min_support):
+    """Best ``top_k`` neighbors of each product in ``product_ids`` as ProductNeighbor rows"""
+    purchases = matrix.diagonal().astype(np.float64)
+    rows = matrix[product_ids].tocoo()
+    keep = (rows.data >= min_support) & (product_ids[rows.row] != rows.col)
+    sources = product_ids[rows.row[keep]]
+    targets = rows.col[keep]
+    scores = rows.data[keep] / np.sqrt(purchases[sources] * purchases[targets])
+
+    # Sort by product, then best score first, and keep the first top_k of each product
+    order = np.lexsort((targets, -scores, sources))
+    sources, targets, scores = sources[order], targets[order], scores[order]
+    starts = np.searchsorted(sources, sources, side='left')
+    ranks = np.arange(len(sources)) - starts
+    keep = ranks < top_k
+    return [{'product_id': int(source), 'rank': int(rank), 'neighbor_id': int(target), 'score': float(score)}
+            for source, rank, target, score in zip(sources[keep], ranks[keep], targets[keep], scores[keep])]
+
+
+def refresh(state_path, top_k=TOP_K, min_support=1, full=False):
+    """Count orders placed since the last run and rewrite the neighbors that changed.
+
+    With ``full=True`` (or without a saved state) every order is counted
+    again and every product's neighbors are rewritten.  Returns a stats dict.
+    """
+    started = time.perf_counter()
+    matrix, scan_after, counted = (None, 0, _empty_ids()) if full else load_state(state_path)
+    rebuild = matrix is None
+    matrix = _grow(matrix, 1)
+
+    new_counts, new_ids = _co_purchases(scan_after, counted, matrix.shape[0])
+    matrix = (_grow(matrix, new_counts.shape[0]) + new_counts).tocsr()
+
+    counted = np.union1d(counted, new_ids).astype(np.int64)
+    last_order_id = int(counted[-1]) if len(counted) else scan_after
+    scan_after = max(scan_after, last_order_id - RESCAN_WINDOW)
+    counted = counted[counted > scan_after]
+
+    if rebuild:
+        affected = np.flatnonzero(matrix.diagonal())
+        db.session.execute(delete(ProductNeighbor))
+    else:
+        # A product's scores change if it was bought again, or if it was ever
+        # bought with a product that was
+        touched = np.flatnonzero(new_counts.diagonal())
+        affected = np.union1d(touched, matrix[touched].nonzero()[1]).astype(np.int64)
+        for start in range(0, len(affected), WRITE_CHUNK):
+            chunk = [int(product_id) for product_id in affected[start:start + WRITE_CHUNK]]
+            db.session.execute(delete(ProductNeighbor).where(ProductNeighbor.product_id.in_(chunk)))
+
+    written = 0
+    for start in range(0, len(affected), WRITE_CHUNK):
+        rows = _top_neighbors(matrix, affected[start:start + WRITE_CHUNK], top_k, min_support)
+        if rows:
+            db.session.execute(insert(ProductNeighbor), rows)
+            written += len(rows)
+    db.session.commit()
+    save_state(state_path, matrix, scan_after, counted)
+
+    return {
+        'last_order_id': last_order_id,
+        'products': len(affected),
+        'neighbors': written,
+        'full': rebuild,
+        'seconds': time.perf_counter() - started,
+    }
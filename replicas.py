@@ -0,0 +1,149 @@
+"""Read replicas and connection pool settings.
+
+``DATABASE_REPLICA_URIS`` lists read-only copies of the primary database.
+Each one becomes a Flask-SQLAlchemy bind (``replica_1``, ``replica_2``, ...).
+Views decorated with ``@read_only`` send their queries to one replica, picked
+per request.  Everything else goes to the primary: other views, CLI
+commands, flushes, INSERT/UPDATE/DELETE statements and ``FOR UPDATE`` reads.
+
+Replicas lag behind the primary.  Once a request has written, the rest of
+that request reads from the primary.  A request that commits a write also
+sets a ``REPLICA_STICKY_COOKIE`` cookie that expires after
+``REPLICA_STICKY_SECONDS``.  While the browser sends it back, read-only views
+use the primary too, so users always see their own changes.
+
+Shared caches (the catalog cache, the facet index, cached identities and
+promo rules) outlive the request that fills them, so their loaders run
+inside ``primary_reads()``: a cache cleared by a commit on the primary is
+never refilled from a replica that has not caught up yet.
+
+``DB_POOL_SIZE``, ``DB_MAX_OVERFLOW``, ``DB_POOL_TIMEOUT``,
+``DB_POOL_RECYCLE`` and ``DB_POOL_PRE_PING`` configure the connection pool
+of the primary and of every replica; unset values keep SQLAlchemy's
+defaults.  Two SQLite files work as primary and replica for local testing.
+"""
+import functools
+import random
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import event
+
+WROTE_KEY = 'replicas_wrote'
+
+_POOL_OPTIONS = {
+    'DB_POOL_SIZE': 'pool_size',
+    'DB_MAX_OVERFLOW': 'max_overflow',
+    'DB_POOL_TIMEOUT': 'pool_timeout',
+    'DB_POOL_RECYCLE': 'pool_recycle',
+    'DB_POOL_PRE_PING': 'pool_pre_ping',
+}
+
+
+def _is_write(clause):
+    return clause is not None and (getattr(clause, 'is_dml', False)
+                                   or getattr(clause, '_for_update_arg', None) is not None)
+
+
+class RoutingSession(FlaskSession):
+    """Session that sends reads in ``@read_only`` views to the request's replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not self.info.get(WROTE_KEY) and not _is_write(clause):
+            replica = g.get('db_replica') if has_app_context() else None
+            if replica is not None:
+                return self._db.engines[replica]
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _note_flush(session, flush_context):
+    session.info[WROTE_KEY] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _note_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info[WROTE_KEY] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _note_committed_write(session):
+    if session.info.get(WROTE_KEY) and has_request_context():
+        g.db_committed_write = True
+
+
+class ReadReplicas:
+    """Flask extension configuring pooling and replica binds; call before ``db.init_app``"""
+
+    def __init__(self, app=None):
+        self.bind_keys = []
+        self.sticky_cookie = 'read_primary'
+        self.sticky_seconds = 10
+        self.routed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 10)
+        app.config.setdefault('REPLICA_STICKY_COOKIE', 'read_primary')
+        for name in _POOL_OPTIONS:
+            app.config.setdefault(name, None)
+
+        pool_options = {option: app.config[name] for name, option in _POOL_OPTIONS.items()
+                        if app.config[name] is not None}
+        engine_options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        for option, value in pool_options.items():
+            engine_options.setdefault(option, value)
+
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+        self.bind_keys = []
+        for number, uri in enumerate(app.config['DATABASE_REPLICA_URIS'], 1):
+            key = f'replica_{number}'
+            binds[key] = {'url': uri, **pool_options}
+            self.bind_keys.append(key)
+        self.sticky_seconds = app.config['REPLICA_STICKY_SECONDS']
+        self.sticky_cookie = app.config['REPLICA_STICKY_COOKIE']
+
+        app.after_request(self._set_sticky_cookie)
+        app.extensions['replicas'] = self
+        metrics = app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.register_gauge('shopease_replica_routed_requests', 'Requests whose reads went to a replica',
+                                   lambda: self.routed)
+
+    def choose(self):
+        """Bind key of the replica for this request, or None to read from the primary"""
+        if not self.bind_keys or request.cookies.get(self.sticky_cookie):
+            return None
+        self.routed += 1
+        return random.choice(self.bind_keys)
+
+    def _set_sticky_cookie(self, response):
+        if self.bind_keys and g.get('db_committed_write'):
+            response.set_cookie(self.sticky_cookie, '1', max_age=self.sticky_seconds, httponly=True, samesite='Lax')
+        return response
+
+
+@contextmanager
+def primary_reads():
+    """Send the block's reads to the primary, even inside a ``@read_only`` view"""
+    replica = g.pop('db_replica', None) if has_app_context() else None
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.db_replica = replica
+
+
+def read_only(view):
+    """Run a view's queries on a read replica when one is configured"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get('replicas')
+        if replicas is not None:
+            g.db_replica = replicas.choose()
+        return view(*args, **kwargs)
+    return wrapper
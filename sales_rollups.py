@@ -0,0 +1,157 @@
+"""Sales rollups maintained alongside orders.
+
+``SalesRollup`` holds orders, units and revenue per product per hour and per
+day, together with the product's category at the time of sale.  Rows with
+``product_id`` 0 hold the totals across all products, so their ``orders``
+count each order once.  A flush hook adds every new order line to its rollup
+rows in the same transaction as the order.  It also takes an order out of
+the rollups, or puts it back, when its status moves into or out of
+``EXCLUDED_STATUSES``.  Reports read only these rows.  ``backfill()``
+rebuilds them from order history in id-range batches, all in one
+transaction: reports keep reading the old rows until the new ones commit,
+and a hook running in another transaction meanwhile waits on the rows the
+rebuild holds, then applies its change on top of the rebuilt totals.
+
+Revenue is line price times quantity, before shipping, tax and discounts.
+"""
+from sqlalchemy import delete, event, func, inspect, or_, select
+from sqlalchemy.orm import Session
+
+from models import db, Order, OrderItem, Product, SalesRollup
+from upserts import increment_rows
+
+GRANULARITIES = ('hour', 'day')
+EXCLUDED_STATUSES = ('cancelled', 'refunded')
+TOTAL = 0
+BACKFILL_BATCH_SIZE = 5000
+WRITE_CHUNK = 500
+
+_KEYS = ('granularity', 'period_start', 'product_id')
+_INCREMENTS = ('orders', 'units', 'revenue')
+
+
+def counts_as_sale(status):
+    return status not in EXCLUDED_STATUSES
+
+
+def period_start(moment, granularity):
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _rollup_rows(lines):
+    """Aggregate ``(order_id, created_at, product_id, category, quantity, price, sign)`` lines into rollup rows"""
+    rows = {}
+    counted_orders = set()
+
+    def row(granularity, start, product_id, category):
+        key = (granularity, start, product_id)
+        if key not in rows:
+            rows[key] = {'granularity': granularity, 'period_start': start, 'product_id': product_id,
+                         'category': category, 'orders': 0, 'units': 0, 'revenue': 0.0}
+        return rows[key]
+
+    for order_id, created_at, product_id, category, quantity, price, sign in lines:
+        for granularity in GRANULARITIES:
+            start = period_start(created_at, granularity)
+            product_row = row(granularity, start, product_id, category)
+            total_row = row(granularity, start, TOTAL, None)
+            for target in (product_row, total_row):
+                target['units'] += sign * quantity
+                target['revenue'] += sign * quantity * price
+            product_row['orders'] += sign
+            if (granularity, order_id, sign) not in counted_orders:
+                counted_orders.add((granularity, order_id, sign))
+                total_row['orders'] += sign
+    return list(rows.values())
+
+
+def _write(lines, connection=None):
+    rows = _rollup_rows(lines)
+    for start in range(0, len(rows), WRITE_CHUNK):
+        increment_rows(SalesRollup, rows[start:start + WRITE_CHUNK], _KEYS, _INCREMENTS, connection)
+    return len(rows)
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_flushed_orders(session, flush_context):
+    # (order, item, sign): new lines of counted orders, and every line of an
+    # order whose status moved into or out of EXCLUDED_STATUSES
+    changes = [(obj.order, obj, 1) for obj in session.new
+               if isinstance(obj, OrderItem) and obj.order is not None and counts_as_sale(obj.order.status)]
+    changes = [change for change in changes if change[0].created_at is not None]
+    for obj in session.dirty:
+        if not isinstance(obj, Order):
+            continue
+        history = inspect(obj).attrs.status.history
+        if history.deleted and history.added:
+            was_counted, is_counted = counts_as_sale(history.deleted[0]), counts_as_sale(history.added[0])
+            if was_counted != is_counted:
+                sign = 1 if is_counted else -1
+                changes += [(obj, item, sign) for item in obj.order_items if item not in session.new]
+    if not changes:
+        return
+
+    connection = session.connection()
+    categories = dict(connection.execute(
+        select(Product.id, Product.category).where(Product.id.in_({item.product_id for _, item, _ in changes}))
+    ).all())
+    _write([(order.id, order.created_at, item.product_id, categories.get(item.product_id),
+             item.quantity, item.price, sign) for order, item, sign in changes], connection)
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """Rebuild every rollup row from order history; returns the number of orders counted"""
+    orders = 0
+    try:
+        db.session.execute(delete(SalesRollup))
+        max_id = db.session.execute(select(func.max(Order.id))).scalar() or 0
+        for low in range(0, max_id + 1, batch_size):
+            lines = db.session.execute(
+                select(Order.id, Order.created_at, OrderItem.product_id, Product.category,
+                       OrderItem.quantity, OrderItem.price)
+                .join(OrderItem, OrderItem.order_id == Order.id)
+                .outerjoin(Product, Product.id == OrderItem.product_id)
+                .where(Order.id >= low, Order.id < low + batch_size, Order.created_at.is_not(None),
+                       or_(Order.status.is_(None), Order.status.not_in(EXCLUDED_STATUSES)))
+            ).all()
+            _write([(*line, 1) for line in lines])
+            orders += len({line.id for line in lines})
+        # One commit: the delete and every batch become visible together
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    return orders
+
+
+def report(granularity, start, end, by='total'):
+    """Rollup rows for ``start <= period_start < end``, oldest first.
+
+    ``by`` is ``total``, ``product`` or ``category``.  Category rows add up
+    their products' units and revenue; they have no order count, because an
+    order can contain several products from one category.
+    """
+    period = SalesRollup.period_start
+    in_range = [SalesRollup.granularity == granularity, period >= start, period < end]
+    if by == 'total':
+        query = (select(period, SalesRollup.orders, SalesRollup.units, SalesRollup.revenue)
+                 .where(*in_range, SalesRollup.product_id == TOTAL)
+                 .order_by(period))
+    elif by == 'product':
+        query = (select(period, SalesRollup.product_id, SalesRollup.category,
+                        SalesRollup.orders, SalesRollup.units, SalesRollup.revenue)
+                 .where(*in_range, SalesRollup.product_id != TOTAL)
+                 .order_by(period, SalesRollup.product_id))
+    elif by == 'category':
+        query = (select(period, SalesRollup.category,
+                        func.sum(SalesRollup.units).label('units'), func.sum(SalesRollup.revenue).label('revenue'))
+                 .where(*in_range, SalesRollup.product_id != TOTAL)
+                 .group_by(period, SalesRollup.category)
+                 .order_by(period, SalesRollup.category))
+    else:
+        raise ValueError(f'Unknown report grouping: {by}')
+
+    return [{**row, 'period_start': row['period_start'].isoformat(), 'revenue': round(row['revenue'], 2)}
+            for row in db.session.execute(query).mappings()]
@@ -0,0 +1,107 @@
+"""In-place schema upgrades for existing databases.
+
+``db.create_all()`` only creates missing tables.  ``upgrade()`` also brings
+existing tables up to date with the models: it adds missing columns, repairs
+data that would violate new unique indexes and creates missing indexes.  Every
+step checks the live schema first, so running it repeatedly is safe.
+"""
+from sqlalchemy import String, cast, delete, func, inspect, literal, select, text, update
+from sqlalchemy.orm import aliased
+
+from models import db, CartItem, Product, WishlistItem
+from pricing import seed_promo_codes
+
+
+def _add_missing_columns(connection, log):
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl_compiler = connection.dialect.ddl_compiler(connection.dialect, None)
+            table_name = connection.dialect.identifier_preparer.format_table(table)
+            ddl = f'ALTER TABLE {table_name} ADD COLUMN {ddl_compiler.get_column_specification(column)}'
+            connection.execute(text(ddl))
+            log(f'Added column {table.name}.{column.name}')
+
+
+def _merge_duplicate_cart_items(connection, log):
+    other = aliased(CartItem)
+    keepers = (select(func.min(CartItem.id))
+               .group_by(CartItem.user_id, CartItem.product_id)
+               .having(func.count() > 1))
+    merged_quantity = (select(func.sum(other.quantity))
+                       .where(other.user_id == CartItem.user_id, other.product_id == CartItem.product_id)
+                       .scalar_subquery())
+    connection.execute(update(CartItem).where(CartItem.id.in_(keepers)).values(quantity=merged_quantity))
+    removed = connection.execute(delete(CartItem).where(
+        CartItem.id.not_in(select(func.min(CartItem.id)).group_by(CartItem.user_id, CartItem.product_id))
+    )).rowcount
+    if removed:
+        log(f'Merged {removed} duplicate cart rows')
+
+
+def _remove_duplicate_wishlist_items(connection, log):
+    removed = connection.execute(delete(WishlistItem).where(
+        WishlistItem.id.not_in(select(func.min(WishlistItem.id))
+                               .group_by(WishlistItem.user_id, WishlistItem.product_id))
+    )).rowcount
+    if removed:
+        log(f'Removed {removed} duplicate wishlist rows')
+
+
+def _backfill_product_skus(connection, log):
+    updated = connection.execute(
+        update(Product).where(Product.sku.is_(None))
+        .values(sku=literal('SE-') + cast(Product.id, String))
+    ).rowcount
+    if updated:
+        log(f'Assigned SKUs to {updated} products')
+
+
+def _backfill_product_updated_at(connection, log):
+    updated = connection.execute(
+        update(Product).where(Product.updated_at.is_(None))
+        .values(updated_at=func.coalesce(Product.created_at, func.current_timestamp()))
+    ).rowcount
+    if updated:
+        log(f'Set updated_at on {updated} products')
+
+
+# Data repairs that must run before the indexes they protect are created
+DATA_FIXES = (
+    _merge_duplicate_cart_items,
+    _remove_duplicate_wishlist_items,
+    _backfill_product_skus,
+    _backfill_product_updated_at,
+)
+
+
+def _create_missing_indexes(connection, log):
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+                log(f'Created index {index.name}')
+
+
+def _seed_promo_codes(connection, log):
+    added = seed_promo_codes(connection)
+    if added:
+        log(f'Added {added} default promo codes')
+
+
+def upgrade(log=print):
+    """Bring the connected database up to date with the models"""
+    db.create_all()
+    with db.engine.begin() as connection:
+        _add_missing_columns(connection, log)
+        for fix in DATA_FIXES:
+            fix(connection, log)
+        _create_missing_indexes(connection, log)
+        _seed_promo_codes(connection, log)
@@ -0,0 +1,309 @@
+"""Benchmark the storefront routes under a realistic traffic mix.
+
+Seeds a throwaway SQLite database at the requested scale (products, users,
+and a cart, a wishlist and past orders for every user).  It then replays a
+weighted mix of browsing, searching, cart changes, checkouts and order
+history through the Flask test client as logged-in users.  For every route it
+reports throughput, p50/p95/p99 latency and SQL statements per request.
+
+    python scripts/bench_storefront.py --products 5000 --users 200 --requests 5000
+    python scripts/bench_storefront.py --json results/$(git rev-parse --short HEAD).json
+    python scripts/bench_storefront.py --compare results/baseline.json
+
+The run is deterministic for a given ``--seed``, so two commits can be
+compared on exactly the same data and request sequence.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CATEGORIES = ('Laptops', 'Phones', 'Audio', 'Wearables', 'Tablets', 'Accessories', 'Cameras', 'Gaming')
+WORDS = ('pro', 'max', 'ultra', 'mini', 'wireless', 'smart', 'classic', 'studio', 'sport', 'lite',
+         'carbon', 'titan', 'nova', 'pixel', 'sonic', 'aero')
+SEARCHES = ('pro', 'wireless', 'smart watch', 'ultra max', 'studio', 'nova lite', 'carbon', 'gaming')
+
+# (route name, relative weight) of the replayed traffic
+TRAFFIC_MIX = (
+    ('products', 20),
+    ('products_category', 10),
+    ('product_detail', 20),
+    ('search', 12),
+    ('cart', 8),
+    ('add_to_cart', 8),
+    ('cart_batch', 8),
+    ('checkout', 4),
+    ('place_order', 2),
+    ('orders', 6),
+    ('dashboard', 2),
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--cart-items', type=int, default=3, help='cart rows per user')
+    parser.add_argument('--orders', type=int, default=10, help='past orders per user')
+    parser.add_argument('--requests', type=int, default=3000, help='measured requests')
+    parser.add_argument('--warmup', type=int, default=200, help='unmeasured requests run first')
+    parser.add_argument('--concurrency', type=int, default=1, help='client threads')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--json', dest='json_path', help='write the results to this file')
+    parser.add_argument('--compare', help='print the change against a previous --json file')
+    return parser.parse_args()
+
+
+args = parse_args()
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix='shopease-bench-'), 'bench.db')
+os.environ['DATABASE_URI'] = f'sqlite:///{DB_FILE}'
+
+from sqlalchemy import event, insert  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+import counters  # noqa: E402
+import main  # noqa: E402
+from models import db, User, Product, CartItem, Order, OrderItem, WishlistItem  # noqa: E402
+from search import rebuild_index  # noqa: E402
+
+
+def seed(rng):
+    db.create_all()
+    started = datetime.utcnow() - timedelta(days=365)
+    products = []
+    for i in range(1, args.products + 1):
+        name = ' '.join(rng.sample(WORDS, 2)).title() + f' {i}'
+        features = ' and '.join(rng.sample(WORDS, 3))
+        products.append({
+            'id': i, 'sku': f'BENCH-{i}', 'name': name, 'description': f'{name} with {features} features',
+            'price': round(rng.uniform(5, 2500), 2), 'stock': rng.randint(50, 500),
+            'category': rng.choice(CATEGORIES), 'created_at': started + timedelta(minutes=i),
+        })
+    db.session.execute(insert(Product), products)
+
+    password = generate_password_hash('bench-password')
+    db.session.execute(insert(User), [
+        {'id': i, 'username': f'bench{i}', 'email': f'bench{i}@example.com', 'password': password}
+        for i in range(1, args.users + 1)
+    ])
+
+    cart_rows, wishlist_rows, order_rows, item_rows = [], [], [], []
+    for user_id in range(1, args.users + 1):
+        for product_id in rng.sample(range(1, args.products + 1), args.cart_items):
+            cart_rows.append({'user_id': user_id, 'product_id': product_id, 'quantity': rng.randint(1, 3)})
+        for product_id in rng.sample(range(1, args.products + 1), 3):
+            wishlist_rows.append({'user_id': user_id, 'product_id': product_id})
+        for _ in range(args.orders):
+            order_id = len(order_rows) + 1
+            lines = [(product_id, rng.randint(1, 2)) for product_id in rng.sample(range(1, args.products + 1), 3)]
+            total = sum(products[product_id - 1]['price'] * quantity for product_id, quantity in lines)
+            order_rows.append({'id': order_id, 'user_id': user_id, 'total': round(total, 2), 'status': 'completed',
+                               'created_at': started + timedelta(hours=order_id)})
+            item_rows += [{'order_id': order_id, 'product_id': product_id, 'quantity': quantity,
+                           'price': products[product_id - 1]['price']} for product_id, quantity in lines]
+    for model, rows in ((CartItem, cart_rows), (WishlistItem, wishlist_rows), (Order, order_rows),
+                        (OrderItem, item_rows)):
+        if rows:
+            db.session.execute(insert(model), rows)
+    db.session.commit()
+    counters.reconcile()
+    rebuild_index()
+
+
+class StatementCounter:
+    """Counts SQL statements per thread"""
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    def value(self):
+        return getattr(self._local, 'count', 0)
+
+
+def make_request(client, route, rng):
+    if route == 'products':
+        return client.get('/products')
+    if route == 'products_category':
+        return client.get('/products', query_string={'category': rng.choice(CATEGORIES)})
+    if route == 'product_detail':
+        return client.get(f'/product/{rng.randint(1, args.products)}')
+    if route == 'search':
+        return client.get('/search', query_string={'q': rng.choice(SEARCHES)})
+    if route == 'cart':
+        return client.get('/cart')
+    if route == 'add_to_cart':
+        return client.get(f'/add_to_cart/{rng.randint(1, args.products)}')
+    if route == 'cart_batch':
+        operations = [{'op': rng.choice(('increase', 'decrease')), 'item_id': rng.randint(1, args.products)}
+                      for _ in range(rng.randint(1, 4))]
+        return client.post('/cart/batch', json={'operations': operations})
+    if route == 'checkout':
+        return client.get('/checkout')
+    if route == 'place_order':
+        return client.post('/checkout')
+    if route == 'orders':
+        return client.get('/orders')
+    if route == 'dashboard':
+        return client.get('/dashboard')
+    raise ValueError(route)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def replay(app, statements, rng_seed, user_ids, count, samples):
+    rng = random.Random(rng_seed)
+    routes, weights = zip(*TRAFFIC_MIX)
+    clients = {}
+    for _ in range(count):
+        user_id = rng.choice(user_ids)
+        client = clients.get(user_id)
+        if client is None:
+            client = clients[user_id] = app.test_client()
+            with client.session_transaction() as sess:
+                sess['_user_id'] = str(user_id)
+                sess['_fresh'] = True
+        route = rng.choices(routes, weights)[0]
+
+        statements.reset()
+        started = time.perf_counter()
+        response = make_request(client, route, rng)
+        elapsed = time.perf_counter() - started
+        if samples is not None:
+            samples[route].append((elapsed, statements.value(), response.status_code >= 500))
+
+
+def run():
+    app = main.app
+    rng = random.Random(args.seed)
+    seed_started = time.perf_counter()
+    with app.app_context():
+        seed(rng)
+        statements = StatementCounter(db.engine)
+    seed_seconds = time.perf_counter() - seed_started
+    print(f'Seeded {args.products:,} products and {args.users:,} users in {seed_seconds:.1f}s')
+
+    user_ids = list(range(1, args.users + 1))
+    replay(app, statements, args.seed, user_ids, args.warmup, None)
+
+    samples = defaultdict(list)
+    per_thread = [args.requests // args.concurrency + (1 if i < args.requests % args.concurrency else 0)
+                  for i in range(args.concurrency)]
+    threads = [threading.Thread(target=replay, args=(app, statements, args.seed + 1 + i, user_ids, n, samples))
+               for i, n in enumerate(per_thread)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    routes = {}
+    for route, _ in TRAFFIC_MIX:
+        route_samples = samples.get(route, [])
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in route_samples)
+        queries = [count for _, count, _ in route_samples]
+        routes[route] = {
+            'requests': len(route_samples),
+            'errors': sum(1 for _, _, failed in route_samples if failed),
+            'throughput': len(route_samples) / wall,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'mean_ms': sum(latencies) / len(latencies) if latencies else 0.0,
+            'queries_per_request': sum(queries) / len(queries) if queries else 0.0,
+            'max_queries': max(queries, default=0),
+        }
+    all_latencies = sorted(elapsed * 1000 for route_samples in samples.values() for elapsed, _, _ in route_samples)
+    total = len(all_latencies)
+    overall = {
+        'requests': total,
+        'errors': sum(route['errors'] for route in routes.values()),
+        'seconds': wall,
+        'throughput': total / wall,
+        'p50_ms': percentile(all_latencies, 0.50),
+        'p95_ms': percentile(all_latencies, 0.95),
+        'p99_ms': percentile(all_latencies, 0.99),
+        'queries_per_request': sum(count for route_samples in samples.values()
+                                   for _, count, _ in route_samples) / total if total else 0.0,
+    }
+    return {'meta': run_metadata(seed_seconds), 'overall': overall, 'routes': routes}
+
+
+def run_metadata(seed_seconds):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed_seconds': seed_seconds,
+        'args': {key: value for key, value in vars(args).items() if key not in ('json_path', 'compare')},
+    }
+
+
+def print_report(results, baseline=None):
+    header = f'{"route":<18} {"reqs":>6} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8} {"errors":>6}'
+    print('\n' + header)
+    print('-' * len(header))
+    rows = list(results['routes'].items()) + [('ALL', results['overall'])]
+    for route, stats in rows:
+        print(f'{route:<18} {stats["requests"]:>6} {stats["throughput"]:>8.1f} {stats["p50_ms"]:>8.2f} '
+              f'{stats["p95_ms"]:>8.2f} {stats["p99_ms"]:>8.2f} {stats["queries_per_request"]:>8.2f} '
+              f'{stats["errors"]:>6}')
+
+    if baseline is None:
+        return
+    print(f'\nChange against {baseline["meta"].get("commit") or "baseline"} (negative is better for latency):')
+    base_rows = dict(baseline['routes'], ALL=baseline['overall'])
+    for route, stats in rows:
+        base = base_rows.get(route)
+        if not base or not base['requests']:
+            continue
+        deltas = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if base[key]:
+                deltas.append(f'{key[:-3]} {100 * (stats[key] - base[key]) / base[key]:+.1f}%')
+        deltas.append(f'queries {stats["queries_per_request"] - base["queries_per_request"]:+.2f}')
+        print(f'  {route:<18} ' + ', '.join(deltas))
+
+
+if __name__ == '__main__':
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    results = run()
+    print_report(results, baseline)
+    if args.json_path:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json_path)), exist_ok=True)
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'\nWrote {args.json_path}')
@@ -0,0 +1,126 @@
+"""Fail when a storefront route issues more SQL statements than its budget.
+
+Seeds a throwaway SQLite database with a user who has a full cart, a wishlist
+and several pages of orders, then requests every route through the Flask test
+client and counts the statements sent to the database.  Budgets are fixed
+numbers, so a lazy relationship sneaking back into a template (N+1) shows up
+as a failure.
+
+    python scripts/check_query_budgets.py
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DB_FILE = os.path.join(tempfile.mkdtemp(prefix='shopease-queries-'), 'budget.db')
+os.environ['DATABASE_URI'] = f'sqlite:///{DB_FILE}'
+
+from sqlalchemy import event  # noqa: E402
+
+import main  # noqa: E402
+from models import db, User, Product, CartItem, Order, OrderItem, WishlistItem  # noqa: E402
+
+# Maximum number of SQL statements per request for a logged-in user.  Only
+# the first page loads the user; later ones find it in the identity cache.
+# Every page reads the user's counters once, by primary key, for the cart
+# badge, and the dashboard figures come from the same read.  Catalog pages are measured
+# with a cold cache, so these are worst cases; the facet index is built at
+# startup, as the server does, and a product page with no recommendations yet looks up
+# its neighbors before falling back to the same category.  The cart and
+# checkout pages price the cart from the lines they load, with no extra query.
+ROUTE_BUDGETS = {
+    '/': 2,
+    '/products': 4,
+    '/products?category=Accessories': 4,
+    '/products?search=pro': 4,
+    '/product/1': 4,
+    '/search?q=pro': 4,
+    '/dashboard': 2,
+    '/cart': 3,
+    '/checkout': 2,
+    '/orders': 3,
+}
+
+EXTRA_PRODUCTS = 40
+CART_ITEMS = 6
+WISHLIST_ITEMS = 4
+ORDERS = 25
+ITEMS_PER_ORDER = 3
+
+
+@contextmanager
+def count_queries(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def seed():
+    db.create_all()
+    main.create_sample_data()
+    for i in range(EXTRA_PRODUCTS):
+        db.session.add(Product(name=f'Budget Product {i}', description=f'Seeded product number {i}',
+                               price=10 + i, stock=100, category='Accessories'))
+    user = User(username='budget', email='budget@example.com', password='x')
+    db.session.add(user)
+    db.session.flush()
+
+    products = Product.query.order_by(Product.id).all()
+    for product in products[:CART_ITEMS]:
+        db.session.add(CartItem(user_id=user.id, product_id=product.id, quantity=2))
+    for product in products[:WISHLIST_ITEMS]:
+        db.session.add(WishlistItem(user_id=user.id, product_id=product.id))
+    for i in range(ORDERS):
+        order = Order(user_id=user.id, total=0, status='completed')
+        db.session.add(order)
+        db.session.flush()
+        for product in products[i:i + ITEMS_PER_ORDER]:
+            db.session.add(OrderItem(order_id=order.id, product_id=product.id, quantity=1, price=product.price))
+    db.session.commit()
+    return user.id
+
+
+def run():
+    app = main.app
+    with app.app_context():
+        user_id = seed()
+        main.facets.rebuild()
+        engine = db.engine
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+
+    failures = []
+    for path, budget in ROUTE_BUDGETS.items():
+        with count_queries(engine) as statements:
+            response = client.get(path)
+        status = 'ok' if len(statements) <= budget else 'OVER BUDGET'
+        print(f'{path:<35} {response.status_code}  {len(statements):>3} / {budget:<3} {status}')
+        if response.status_code >= 400:
+            failures.append(f'{path} returned {response.status_code}')
+        elif len(statements) > budget:
+            failures.append(f'{path} issued {len(statements)} statements (budget {budget})')
+            for statement in statements:
+                print('    ' + ' '.join(statement.split())[:160])
+    return failures
+
+
+if __name__ == '__main__':
+    problems = run()
+    if problems:
+        print('\n'.join(['', 'Query budget check failed:'] + problems))
+        sys.exit(1)
+    print('\nAll routes within their query budgets.')
@@ -0,0 +1,140 @@
+"""Check that read-only views read from a replica and writers read their writes.
+
+Seeds a throwaway SQLite primary, copies it to a second SQLite file that
+serves as the replica, then renames a product in the replica only, so every
+page shows which database it read.  It then counts the statements each engine
+receives while requesting pages through the Flask test client:
+
+- read-only catalog pages go to the replica, other pages to the primary;
+- shared caches are filled from the primary, even inside read-only pages;
+- after a request commits a write, the same browser reads from the primary
+  until the sticky cookie expires;
+- the configured pool settings reach both engines.
+
+    python scripts/check_replica_routing.py
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DB_DIR = tempfile.mkdtemp(prefix='shopease-replicas-')
+PRIMARY_FILE = os.path.join(DB_DIR, 'primary.db')
+REPLICA_FILE = os.path.join(DB_DIR, 'replica.db')
+os.environ['DATABASE_URI'] = f'sqlite:///{PRIMARY_FILE}'
+os.environ['DATABASE_REPLICA_URIS'] = f'sqlite:///{REPLICA_FILE}'
+os.environ['DB_POOL_SIZE'] = '3'
+# Read every page straight from the database so the routing is visible
+os.environ['CATALOG_CACHE_BACKEND'] = 'none'
+
+from sqlalchemy import event  # noqa: E402
+
+import main  # noqa: E402
+from catalog_cache import LRUCache, NullCache  # noqa: E402
+from models import db, User, Product  # noqa: E402
+
+REPLICA_NAME = 'Replica Copy'
+
+
+@contextmanager
+def count_statements(engines):
+    counts = {name: 0 for name in engines}
+    listeners = []
+    for name, engine in engines.items():
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany, name=name):
+            counts[name] += 1
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        listeners.append((engine, before_cursor_execute))
+    try:
+        yield counts
+    finally:
+        for engine, listener in listeners:
+            event.remove(engine, 'before_cursor_execute', listener)
+
+
+def seed():
+    db.create_all()
+    main.create_sample_data()
+    user = User(username='replica', email='replica@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    db.engine.dispose()
+    shutil.copy(PRIMARY_FILE, REPLICA_FILE)
+    with sqlite3.connect(REPLICA_FILE) as connection:
+        connection.execute('UPDATE product SET name = ? WHERE id = 1', (REPLICA_NAME,))
+    # The facet index is always built from the primary; build it now so the
+    # listing below shows only the page's own reads
+    main.facets.rebuild()
+    return user_id
+
+
+def run():
+    app = main.app
+    failures = []
+
+    def check(condition, message):
+        print(('ok      ' if condition else 'FAILED  ') + message)
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        user_id = seed()
+        engines = {'primary': db.engines[None], 'replica': db.engines['replica_1']}
+    for name, engine in engines.items():
+        check(engine.pool.size() == 3, f'{name} pool size is DB_POOL_SIZE ({engine.pool.size()})')
+
+    client = app.test_client()
+    with count_statements(engines) as counts:
+        response = client.get('/products')
+    check(counts['replica'] > 0 and counts['primary'] == 0,
+          f'anonymous product listing reads the replica {counts}')
+    check(REPLICA_NAME.encode() in response.data, 'product listing shows the replica copy')
+
+    main.catalog_cache.backend = LRUCache()
+    with count_statements(engines) as counts:
+        response = client.get('/products?page=1')
+    main.catalog_cache.backend = NullCache()
+    check(counts['replica'] == 0 and counts['primary'] > 0,
+          f'a read-only page fills the catalog cache from the primary {counts}')
+    check(REPLICA_NAME.encode() not in response.data, 'the cached listing holds the primary copy')
+
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    with count_statements(engines) as counts:
+        client.get('/cart')
+    check(counts['replica'] == 0 and counts['primary'] > 0, f'cart page (not read-only) reads the primary {counts}')
+    with count_statements(engines) as counts:
+        client.get('/add_to_cart/2')
+    check(counts['replica'] == 0, f'adding to the cart writes to the primary {counts}')
+    cookie = client.get_cookie(app.config['REPLICA_STICKY_COOKIE'])
+    check(cookie is not None, 'a committed write sets the sticky cookie')
+
+    with count_statements(engines) as counts:
+        response = client.get('/products')
+    check(counts['replica'] == 0 and counts['primary'] > 0,
+          f'after a write the same browser reads the primary {counts}')
+    check(REPLICA_NAME.encode() not in response.data, 'product listing shows the primary copy')
+
+    client.delete_cookie(app.config['REPLICA_STICKY_COOKIE'])
+    with count_statements(engines) as counts:
+        client.get('/orders')
+    check(counts['replica'] > 0, f'once the cookie expires, order history reads the replica again {counts}')
+
+    with app.app_context():
+        check(db.session.get(Product, 1).name != REPLICA_NAME, 'the primary was never written through the replica')
+    return failures
+
+
+if __name__ == '__main__':
+    problems = run()
+    if problems:
+        print('\nReplica routing check failed.')
+        sys.exit(1)
+    print('\nReplica routing works.')
@@ -0,0 +1,126 @@
+"""Hammer order placement from many threads and check nothing is oversold.
+
+Seeds a throwaway SQLite database with one scarce "hot" product and a pool
+of shoppers who each have it (plus a plentiful product) in their cart, then
+places every order concurrently with ``checkout.place_order``.  Afterwards
+the stock left plus the units sold must equal the starting stock, and no
+product may go negative.
+
+    python scripts/stress_checkout.py [--shoppers 200] [--threads 16] [--stock 50]
+
+Pass ``--database-uri`` to run against another database instead.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shoppers', type=int, default=200, help='users checking out at once')
+    parser.add_argument('--threads', type=int, default=16, help='worker threads')
+    parser.add_argument('--stock', type=int, default=50, help='starting stock of the hot product')
+    parser.add_argument('--quantity', type=int, default=1, help='units of the hot product per cart')
+    parser.add_argument('--database-uri', help='database to use instead of a temporary SQLite file')
+    return parser.parse_args()
+
+
+args = parse_args()
+if args.database_uri:
+    os.environ['DATABASE_URI'] = args.database_uri
+else:
+    DB_FILE = os.path.join(tempfile.mkdtemp(prefix='shopease-stress-'), 'stress.db')
+    os.environ['DATABASE_URI'] = f'sqlite:///{DB_FILE}'
+
+from sqlalchemy import func, select  # noqa: E402
+
+import main  # noqa: E402
+from checkout import CheckoutError, place_order  # noqa: E402
+from models import db, User, Product, CartItem, OrderItem  # noqa: E402
+
+
+def seed():
+    db.drop_all()
+    db.create_all()
+    hot = Product(name='Hot Deal', description='Flash sale item', price=19.99, stock=args.stock, category='Sale')
+    plenty = Product(name='Plenty', description='Always in stock', price=4.99,
+                     stock=args.shoppers * 10, category='Sale')
+    db.session.add_all([hot, plenty])
+    users = [User(username=f'shopper{i}', email=f'shopper{i}@example.com', password='x')
+             for i in range(args.shoppers)]
+    db.session.add_all(users)
+    db.session.flush()
+    for user in users:
+        db.session.add(CartItem(user_id=user.id, product_id=hot.id, quantity=args.quantity))
+        db.session.add(CartItem(user_id=user.id, product_id=plenty.id, quantity=2))
+    db.session.commit()
+    return [user.id for user in users], {hot.id: hot.stock, plenty.id: plenty.stock}
+
+
+def run():
+    app = main.app
+    with app.app_context():
+        user_ids, initial_stock = seed()
+
+    outcomes = {'placed': 0, 'sold_out': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def checkout(user_id):
+        with app.app_context():
+            try:
+                place_order(user_id)
+                outcome = 'placed'
+            except CheckoutError:
+                outcome = 'sold_out'
+            except Exception as e:
+                print(f'shopper {user_id}: {e.__class__.__name__}: {e}')
+                outcome = 'failed'
+            finally:
+                db.session.remove()
+        with lock:
+            outcomes[outcome] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(checkout, user_ids))
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        stock = dict(db.session.execute(select(Product.id, Product.stock)).all())
+        sold = dict(db.session.execute(
+            select(OrderItem.product_id, func.sum(OrderItem.quantity)).group_by(OrderItem.product_id)).all())
+
+    print(f'{args.shoppers} checkouts on {args.threads} threads in {elapsed:.2f}s '
+          f'({outcomes["placed"] / elapsed:.1f} orders/sec)')
+    print(f'placed {outcomes["placed"]}, sold out {outcomes["sold_out"]}, failed {outcomes["failed"]}')
+
+    problems = []
+    for product_id, starting in initial_stock.items():
+        units_sold = sold.get(product_id, 0)
+        print(f'product {product_id}: start {starting}, sold {units_sold}, left {stock[product_id]}')
+        if stock[product_id] < 0:
+            problems.append(f'product {product_id} went negative ({stock[product_id]})')
+        if stock[product_id] + units_sold != starting:
+            problems.append(f'product {product_id} stock does not add up')
+    hot_id = min(initial_stock)
+    if outcomes['placed'] != min(args.shoppers, args.stock // args.quantity):
+        problems.append(f'expected {min(args.shoppers, args.stock // args.quantity)} orders, '
+                        f'got {outcomes["placed"]}')
+    if sold.get(hot_id, 0) > initial_stock[hot_id]:
+        problems.append('hot product oversold')
+    return problems
+
+
+if __name__ == '__main__':
+    problems = run()
+    if problems:
+        print('\n'.join(['', 'Stress check failed:'] + problems))
+        sys.exit(1)
+    print('\nNo overselling.')
@@ -0,0 +1,150 @@
+"""Product search backed by an inverted index stored in the ``search_term`` table.
+
+Every product is tokenized into ``(term, product_id, weight)`` rows.  The index
+is kept in sync inside the same transaction that changes a product, so a
+search never sees a product that was rolled back.  Queries are prefix range
+scans on the ``term`` primary key, so no ``LIKE '%q%'`` table scan is needed.
+"""
+import re
+from collections import Counter
+
+from sqlalchemy import case, delete, event, func, insert, inspect, select, union_all
+from sqlalchemy.orm import Session
+
+from models import db, Product, SearchTerm
+from pagination import Page
+
+# Field weights used when scoring a term for a product
+FIELD_WEIGHTS = (('name', 3.0), ('category', 2.0), ('description', 1.0))
+INDEXED_FIELDS = tuple(field for field, _ in FIELD_WEIGHTS)
+
+EXACT_MATCH_BOOST = 1.5
+MIN_PREFIX_LENGTH = 2
+MAX_QUERY_TERMS = 8
+MAX_TERM_LENGTH = 64
+MAX_PER_PAGE = 48
+REBUILD_BATCH_SIZE = 1000
+
+STOP_WORDS = frozenset({
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is',
+    'it', 'of', 'on', 'or', 'the', 'to', 'with',
+})
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Split text into lowercase index terms"""
+    if not text:
+        return []
+    return [token[:MAX_TERM_LENGTH] for token in _TOKEN_RE.findall(text.casefold())
+            if token not in STOP_WORDS]
+
+
+def product_terms(product):
+    """Return a {term: weight} mapping for a product"""
+    weights = Counter()
+    for field, weight in FIELD_WEIGHTS:
+        for token in tokenize(getattr(product, field)):
+            weights[token] += weight
+    return weights
+
+
+def index_products(connection, products):
+    """(Re)write the index rows for the given products"""
+    products = [product for product in products if product.id is not None]
+    if not products:
+        return
+    unindex_products(connection, [product.id for product in products])
+    rows = [{'term': term, 'product_id': product.id, 'weight': weight}
+            for product in products
+            for term, weight in product_terms(product).items()]
+    if rows:
+        connection.execute(insert(SearchTerm), rows)
+
+
+def unindex_products(connection, product_ids):
+    if product_ids:
+        connection.execute(delete(SearchTerm).where(SearchTerm.product_id.in_(product_ids)))
+
+
+def _text_changed(product):
+    state = inspect(product)
+    return any(state.attrs[field].history.has_changes() for field in INDEXED_FIELDS)
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_index(session, flush_context):
+    changed = [obj for obj in session.new if isinstance(obj, Product)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Product) and _text_changed(obj)]
+    removed = [obj.id for obj in session.deleted if isinstance(obj, Product)]
+    if not changed and not removed:
+        return
+    connection = session.connection()
+    index_products(connection, changed)
+    unindex_products(connection, removed)
+
+
+def rebuild_index(batch_size=REBUILD_BATCH_SIZE):
+    """Rebuild the whole index in batches; returns the number of products indexed"""
+    indexed = 0
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            select(Product).where(Product.id > last_id).order_by(Product.id).limit(batch_size)
+        ).scalars().all()
+        if not batch:
+            break
+        index_products(db.session.connection(), batch)
+        db.session.commit()
+        indexed += len(batch)
+        last_id = batch[-1].id
+        db.session.expunge_all()
+
+    # Drop rows left behind by products removed outside the ORM
+    db.session.execute(delete(SearchTerm).where(~SearchTerm.product_id.in_(select(Product.id))))
+    db.session.commit()
+    return indexed
+
+
+def _term_matches(token):
+    """Per-product best score for one query token (exact or prefix match)"""
+    if len(token) >= MIN_PREFIX_LENGTH:
+        condition = (SearchTerm.term >= token) & (SearchTerm.term < token + '\uffff')
+    else:
+        condition = SearchTerm.term == token
+    score = case((SearchTerm.term == token, SearchTerm.weight * EXACT_MATCH_BOOST),
+                 else_=SearchTerm.weight)
+    return (select(SearchTerm.product_id, func.max(score).label('score'))
+            .where(condition)
+            .group_by(SearchTerm.product_id))
+
+
+def search_products(query, page=1, per_page=24, category=None):
+    """Return a Page of products matching every term in the query, best first"""
+    page = max(page, 1)
+    per_page = max(1, min(per_page, MAX_PER_PAGE))
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not tokens:
+        return Page([], 0, page, per_page)
+
+    matches = union_all(*[_term_matches(token) for token in tokens]).subquery()
+    ranked = (select(matches.c.product_id, func.sum(matches.c.score).label('score'))
+              .group_by(matches.c.product_id)
+              .having(func.count() == len(tokens)))
+    if category:
+        ranked = (ranked.join(Product, Product.id == matches.c.product_id)
+                  .where(Product.category == category))
+
+    ranked = ranked.subquery()
+    total = db.session.execute(select(func.count()).select_from(ranked)).scalar()
+    ids = db.session.execute(
+        select(ranked.c.product_id)
+        .order_by(ranked.c.score.desc(), ranked.c.product_id)
+        .limit(per_page)
+        .offset((page - 1) * per_page)
+    ).scalars().all()
+
+    by_id = {product.id: product for product in Product.query.filter(Product.id.in_(ids))} if ids else {}
+    items = [by_id[product_id] for product_id in ids if product_id in by_id]
+    return Page(items, total, page, per_page)
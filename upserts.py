@@ -0,0 +1,138 @@
+"""Single-statement upserts for cart and wishlist writes.
+
+Cart and wishlist rows are unique per (user_id, product_id), so concurrent
+clicks can no longer create duplicates.  The same applies to any table of
+running totals (see ``increment_rows``).  Instead of reading a row and then
+inserting or updating it, each write is one ``INSERT ... ON CONFLICT`` (or
+``ON DUPLICATE KEY UPDATE`` on MySQL) statement, which is atomic under
+concurrency and costs a single round trip.
+"""
+from sqlalchemy import insert as generic_insert, update
+from sqlalchemy.exc import IntegrityError
+
+import counters
+from models import db, CartItem, WishlistItem
+
+
+def _dialect_name():
+    return db.session.get_bind().dialect.name
+
+
+def _dialect_insert(model):
+    name = _dialect_name()
+    if name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif name in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+    else:
+        return None
+    return insert(model)
+
+
+def increment_cart_items(user_id, quantities):
+    """Add ``{product_id: quantity}`` to a user's cart, creating missing rows.
+
+    Returns ``{product_id: new_quantity}`` when the database can report it in
+    the same statement, otherwise ``None``.
+    """
+    rows = [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity}
+            for product_id, quantity in quantities.items()]
+    if not rows:
+        return {}
+
+    stmt = _dialect_insert(CartItem)
+    if stmt is None:
+        _increment_cart_items_fallback(user_id, quantities)
+        counters.recount_cart(user_id)
+        return None
+
+    stmt = stmt.values(rows)
+    if _dialect_name() in ('mysql', 'mariadb'):
+        db.session.execute(stmt.on_duplicate_key_update(quantity=CartItem.quantity + stmt.inserted.quantity))
+        counters.recount_cart(user_id)
+        return None
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CartItem.user_id, CartItem.product_id],
+        set_={'quantity': CartItem.quantity + stmt.excluded.quantity},
+    ).returning(CartItem.product_id, CartItem.quantity)
+    new_quantities = dict(db.session.execute(stmt).all())
+    # A row whose quantity equals what was just added did not exist before
+    inserted = sum(1 for product_id, quantity in new_quantities.items() if quantity == quantities[product_id])
+    counters.adjust(user_id, cart_count=inserted)
+    return new_quantities
+
+
+def _increment_cart_items_fallback(user_id, quantities):
+    for product_id, quantity in quantities.items():
+        try:
+            with db.session.begin_nested():
+                db.session.execute(generic_insert(CartItem).values(
+                    user_id=user_id, product_id=product_id, quantity=quantity))
+        except IntegrityError:
+            db.session.execute(
+                update(CartItem)
+                .where(CartItem.user_id == user_id, CartItem.product_id == product_id)
+                .values(quantity=CartItem.quantity + quantity)
+            )
+
+
+def increment_cart_item(user_id, product_id, quantity=1):
+    """Add ``quantity`` of a product to a user's cart; returns the new quantity if known"""
+    quantities = increment_cart_items(user_id, {product_id: quantity})
+    return quantities.get(product_id) if quantities is not None else None
+
+
+def increment_rows(model, rows, keys, increments, connection=None):
+    """Insert ``rows`` into ``model``; where a row with the same ``keys`` exists, add
+    the ``increments`` columns onto it instead.  Other columns are only set on insert.
+    """
+    if not rows:
+        return
+    executor = connection or db.session
+    stmt = _dialect_insert(model)
+    if stmt is None:
+        for row in rows:
+            result = executor.execute(
+                update(model)
+                .where(*[getattr(model, key) == row[key] for key in keys])
+                .values({name: getattr(model, name) + row[name] for name in increments})
+            )
+            if result.rowcount == 0:
+                executor.execute(generic_insert(model).values(row))
+        return
+
+    stmt = stmt.values(rows)
+    if _dialect_name() in ('mysql', 'mariadb'):
+        stmt = stmt.on_duplicate_key_update({name: getattr(model, name) + stmt.inserted[name] for name in increments})
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[getattr(model, key) for key in keys],
+            set_={name: getattr(model, name) + stmt.excluded[name] for name in increments},
+        )
+    executor.execute(stmt)
+
+
+def add_wishlist_item(user_id, product_id):
+    """Insert a wishlist row unless it exists; returns True if a row was created"""
+    stmt = _dialect_insert(WishlistItem)
+    if stmt is None:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(generic_insert(WishlistItem).values(user_id=user_id, product_id=product_id))
+            inserted = True
+        except IntegrityError:
+            inserted = False
+    else:
+        stmt = stmt.values(user_id=user_id, product_id=product_id)
+        if _dialect_name() in ('mysql', 'mariadb'):
+            stmt = stmt.prefix_with('IGNORE')
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[WishlistItem.user_id, WishlistItem.product_id])
+        inserted = db.session.execute(stmt).rowcount == 1
+
+    if inserted:
+        counters.adjust(user_id, wishlist_count=1)
+    return inserted